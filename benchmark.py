@@ -0,0 +1,399 @@
+#! /usr/bin/env python
+"""Builds synthetic blogs with mublog.py, and reports how long that takes.
+
+A site is generated for each requested number of posts, with posts modelled on
+the sample posts in src/posts. Each site is then built three times:
+
+  cold  -- from scratch, with --clean
+  warm  -- again, with nothing changed
+  edit  -- after appending a paragraph to one post
+
+For each build, the throughput in posts per second, the peak RSS of the build
+process and the time spent in each stage (from mublog.py --profile) are reported.
+The generated sites are deterministic for a given seed.
+
+With --scaling, markdown2 is benchmarked on its own instead, converting single
+changelog-style documents (headers, comments and long lists of entries linking
+bug numbers) of growing size. Conversion time should grow linearly with the size;
+--compare runs another markdown2.py alongside, e.g. one from an earlier commit.
+
+With --links, markdown2 is benchmarked on reference indexes instead: single
+paragraphs of growing numbers of inline, reference, image and footnote links.
+Conversion time should grow linearly with the number of links; --compare works
+the same.
+
+With --import-time, the time to import markdown2 in a fresh interpreter, as each
+build worker does, is reported instead, and the time to also convert a sample post
+with it. --compare works the same.
+"""
+
+from argparse import ArgumentParser
+from glob import glob
+import importlib.util
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "src")
+
+CONFIG = """\
+[Paths]
+src_root = src
+src_posts = ${src_root}/posts
+src_css = ${src_root}/css
+src_assets = ${src_root}/assets
+dst_root = dst
+dst_posts = ${dst_root}/posts
+dst_css = ${dst_root}/css
+dst_assets = ${dst_root}/assets
+draft_prefix = _
+
+[Author]
+name = John Doe
+mail = johndoe@example.com
+
+[Layout]
+footer = Copyright 2023 John Doe
+"""
+
+SCENARIOS = ("cold", "warm", "edit")
+LINK_PATTERNS = [(re.compile(r"bug (\d+)"), r"https://bugs.example.com/\1")]
+
+# Run in a fresh interpreter: imports the markdown2.py at argv[1], converts the
+# post at argv[2], and prints the seconds taken by each.
+IMPORT_SCRIPT = """\
+import importlib.util, sys, time
+sys.dont_write_bytecode = False
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("markdown2", sys.argv[1])
+markdown2 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(markdown2)
+imported = time.perf_counter()
+with open(sys.argv[2], encoding="utf-8") as f:
+    markdown2.Markdown(extras=["metadata"]).convert(f.read())
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+class PostGenerator:
+    """Generates posts with the vocabulary and structure of the sample posts"""
+
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+        text = ""
+        for post in sorted(glob(os.path.join(SRC, "posts", "*.md"))):
+            with open(post, encoding="utf-8") as f:
+                text += f.read()
+        self.words = sorted(set(re.findall(r"\b[a-z]{3,}\b", text)))
+        self.images = sorted(os.path.basename(p) for p in glob(os.path.join(SRC, "assets", "*")))
+
+    def phrase(self, lo: int, hi: int) -> str:
+        return " ".join(self.random.choice(self.words) for _ in range(self.random.randint(lo, hi)))
+
+    def title(self) -> str:
+        return self.phrase(2, 6).title()
+
+    def sentence(self) -> str:
+        words = self.phrase(6, 18)
+        r = self.random.random()
+        if r < 0.1:
+            words += f" *{self.phrase(1, 3)}*"
+        elif r < 0.2:
+            words += f" **{self.phrase(1, 3)}**"
+        elif r < 0.3:
+            words += f" [{self.phrase(1, 3)}](https://example.com/{self.random.choice(self.words)})"
+        elif r < 0.35:
+            words += f" `{self.random.choice(self.words)}()`"
+        return words[0].upper() + words[1:] + "."
+
+    def paragraph(self) -> str:
+        return " ".join(self.sentence() for _ in range(self.random.randint(2, 7)))
+
+    def block(self) -> str:
+        r = self.random.random()
+        if r < 0.55:
+            return self.paragraph()
+        elif r < 0.7:
+            return "\n".join(f"- {self.sentence()}" for _ in range(self.random.randint(2, 6)))
+        elif r < 0.8:
+            return "\n".join(f"{i}. {self.sentence()}" for i in range(1, self.random.randint(3, 7)))
+        elif r < 0.88:
+            lines = [f"    {self.random.choice(self.words)} = {self.random.randint(0, 999)}"
+                     for _ in range(self.random.randint(2, 8))]
+            return "\n".join(lines)
+        elif r < 0.94 and self.images:
+            return f'<img src="../assets/{self.random.choice(self.images)}">'
+        else:
+            return f"> {self.paragraph()}"
+
+    def post(self, index: int) -> str:
+        date = f"{self.random.randint(2000, 2023)}-{self.random.randint(1, 12):02}-{self.random.randint(1, 28):02}"
+        tags = ",".join(self.phrase(1, 2) for _ in range(self.random.randint(1, 5)))
+        lines = [
+            "---",
+            f"title: {self.title()} {index}",
+            f"description: {self.phrase(4, 10)}",
+            f"date: {date}",
+            f"tags: {tags}",
+            "---",
+        ]
+        for _ in range(self.random.randint(2, 6)):
+            lines.append(f"# {self.title()}")
+            lines.append("")
+            for _ in range(self.random.randint(1, 5)):
+                lines.append(self.block())
+                lines.append("")
+        return "\n".join(lines)
+
+    def changelog(self, size: int) -> str:
+        """Generates a changelog of about size characters"""
+        parts = []
+        length = 0
+        version = 0
+        while length < size:
+            version += 1
+            lines = [f"## Version 1.{version}", "", f"<!-- released {self.phrase(1, 3)} -->", ""]
+            for _ in range(self.random.randint(3, 12)):
+                lines.append(f"- {self.sentence()} (bug {self.random.randint(1, 99999)})")
+            lines.append("")
+            part = "\n".join(lines) + "\n"
+            parts.append(part)
+            length += len(part)
+        return "".join(parts)
+
+    def link_index(self, links: int) -> str:
+        """Generates a paragraph of the given number of links, one per line,
+        followed by the definitions of the reference links and footnotes
+        """
+        lines = []
+        definitions = []
+        for i in range(links):
+            text = self.phrase(1, 4)
+            kind = i % 4
+            if kind == 0:
+                lines.append(f'[{text}](https://example.com/{i} "{self.phrase(1, 3)}")')
+            elif kind == 1:
+                lines.append(f"[{text}][ref{i}]")
+                definitions.append(f"[ref{i}]: https://example.com/{i}")
+            elif kind == 2:
+                lines.append(f"![{text}](/images/{i}.png)")
+            else:
+                lines.append(f"{text}[^{i}]")
+                definitions.append(f"[^{i}]: {self.sentence()}")
+        return "\n".join(lines) + "\n\n" + "\n\n".join(definitions) + "\n"
+
+
+def generate_site(site: str, posts: int, seed: int):
+    """Generates a site with the given number of posts in the directory site"""
+    shutil.rmtree(site, ignore_errors=True)
+    os.makedirs(os.path.join(site, "src", "posts"))
+    with open(os.path.join(site, "config.ini"), "w", encoding="utf-8") as f:
+        f.write(CONFIG)
+    for name in ("post.html", "index.md", "about.md", "articles.md"):
+        shutil.copy(os.path.join(SRC, name), os.path.join(site, "src", name))
+    for name in ("css", "assets"):
+        shutil.copytree(os.path.join(SRC, name), os.path.join(site, "src", name))
+
+    generator = PostGenerator(seed)
+    for i in range(posts):
+        with open(os.path.join(site, "src", "posts", f"post_{i:06}.md"), "w", encoding="utf-8") as f:
+            f.write(generator.post(i))
+
+
+def run_build(site: str, args: list[str], jobs: int) -> dict:
+    """Runs mublog.py in the site directory, and returns its timings"""
+    report = os.path.join(site, "profile.json")
+    command = [sys.executable, os.path.join(HERE, "mublog.py"), "--jobs", str(jobs), "--profile", report] + args
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=site, stdout=subprocess.DEVNULL)
+    _pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.exit(f"Build failed with exit code {process.returncode}: {' '.join(command)}")
+
+    with open(report, encoding="utf-8") as f:
+        profile = json.load(f)
+    os.remove(report)
+    return {
+        "seconds": seconds,
+        # ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+        "peak_rss_mb": usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "built": len(profile["pages"]),
+        "stages": {name: stage["seconds"] for name, stage in profile["stages"].items()},
+    }
+
+
+def edit_post(site: str):
+    posts = sorted(glob(os.path.join(site, "src", "posts", "*.md")))
+    with open(posts[len(posts) // 2], "a", encoding="utf-8") as f:
+        f.write("\nAn edited paragraph, to rebuild this post.\n")
+
+
+def benchmark(site: str, posts: int, seed: int, jobs: int) -> dict[str, dict]:
+    print(f"Generating {posts} posts in {site} ...")
+    generate_site(site, posts, seed)
+
+    results = {}
+    for scenario in SCENARIOS:
+        if scenario == "edit":
+            edit_post(site)
+        result = run_build(site, ["--clean"] if scenario == "cold" else [], jobs)
+        result["posts_per_second"] = posts / result["seconds"]
+        results[scenario] = result
+        print(f'    {scenario:<5} {result["seconds"]:>9.2f} s {result["posts_per_second"]:>10.1f} posts/s '
+              f'{result["peak_rss_mb"]:>8.1f} MB  (pages built: {result["built"]})')
+    return results
+
+
+def print_stages(results: dict[int, dict[str, dict]]):
+    columns = [(posts, scenario) for posts in results for scenario in SCENARIOS]
+    names = []
+    for posts, scenario in columns:
+        for name in results[posts][scenario]["stages"]:
+            if name not in names:
+                names.append(name)
+
+    print()
+    print(f'{"stage (s)":<18}' + "".join(f"{f'{posts}/{scenario}':>14}" for posts, scenario in columns))
+    for name in names:
+        times = [results[posts][scenario]["stages"].get(name, 0.0) for posts, scenario in columns]
+        print(f"{name:<18}" + "".join(f"{t:>14.3f}" for t in times))
+
+
+def load_markdown(module_path: str):
+    spec = importlib.util.spec_from_file_location(f"markdown2_{abs(hash(module_path))}", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def benchmark_scaling(sizes: list[int], seed: int, module_paths: list[str]):
+    """Converts changelogs of the given sizes in kilobytes with each markdown2 module"""
+    modules = [load_markdown(module_path) for module_path in module_paths]
+    print(f'{"size (KB)":>10}' + "".join(f"{'s':>10}{'s/MB':>10}" for _ in modules)
+          + "".join(f"  {module_path}" for module_path in module_paths))
+    for size in sizes:
+        text = PostGenerator(seed).changelog(size * 1024)
+        line = f"{size:>10}"
+        for module in modules:
+            md = module.Markdown(extras=["link-patterns"], link_patterns=LINK_PATTERNS)
+            start = time.perf_counter()
+            md.convert(text)
+            seconds = time.perf_counter() - start
+            line += f"{seconds:>10.2f}{seconds / (size / 1024):>10.2f}"
+        print(line, flush=True)
+
+
+# The paragraphs of --links: links, and brackets and parentheses that are never closed.
+LINK_TEXTS = {
+    "links": lambda generator, count: generator.link_index(count),
+    "[a](b ": lambda generator, count: "[a](b " * count,
+    "[": lambda generator, count: "[" * count,
+}
+
+
+def benchmark_links(counts: list[int], seed: int, module_paths: list[str]):
+    """Converts paragraphs of the given numbers of links, and unclosed ones, with each markdown2 module"""
+    modules = [load_markdown(module_path) for module_path in module_paths]
+    print(f'{"text":>8}{"links":>10}' + "".join(f"{'s':>10}{'us/link':>10}" for _ in modules)
+          + "".join(f"  {module_path}" for module_path in module_paths))
+    for kind, link_text in LINK_TEXTS.items():
+        for count in counts:
+            text = link_text(PostGenerator(seed), count)
+            line = f"{kind:>8}{count:>10}"
+            for module in modules:
+                md = module.Markdown(extras=["footnotes"])
+                start = time.perf_counter()
+                md.convert(text)
+                seconds = time.perf_counter() - start
+                line += f"{seconds:>10.3f}{seconds / count * 1e6:>10.1f}"
+            print(line, flush=True)
+
+
+def benchmark_import(module_paths: list[str], runs: int, seed: int):
+    """Times importing each markdown2 module, and converting a post with it, in fresh interpreters"""
+    with tempfile.TemporaryDirectory(prefix="mublog-bench-") as root:
+        post = os.path.join(root, "post.md")
+        with open(post, "w", encoding="utf-8") as f:
+            f.write(PostGenerator(seed).post(0))
+
+        print(f'{"import (ms)":>12}{"min":>8}{"+convert":>10}{"min":>8}')
+        for module_path in module_paths:
+            command = [sys.executable, "-c", IMPORT_SCRIPT, module_path, post]
+            # The first run writes the bytecode, which the build workers would find.
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            imports, totals = [], []
+            for _ in range(runs):
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                import_seconds, convert_seconds = map(float, output.split())
+                imports.append(import_seconds * 1000)
+                totals.append((import_seconds + convert_seconds) * 1000)
+            imports.sort()
+            totals.sort()
+            print(f"{imports[runs // 2]:>12.1f}{imports[0]:>8.1f}{totals[runs // 2]:>10.1f}{totals[0]:>8.1f}"
+                  f"  {module_path}", flush=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark mublog.py on generated sites")
+    parser.add_argument("--posts", metavar="N", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="numbers of posts of the generated sites (default: 1000 10000 100000)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of build processes (default: number of CPUs)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated posts (default: 0)")
+    parser.add_argument("--dir", metavar="DIR",
+                        help="directory to generate the sites in (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the generated sites")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE")
+    parser.add_argument("--scaling", action="store_true",
+                        help="benchmark markdown2 on single documents of growing size instead")
+    parser.add_argument("--sizes", metavar="KB", type=int, nargs="+", default=[100, 500, 1000, 2000, 5000],
+                        help="sizes of the documents with --scaling (default: 100 500 1000 2000 5000)")
+    parser.add_argument("--links", action="store_true",
+                        help="benchmark markdown2 on paragraphs of growing numbers of links, "
+                             "and of unclosed brackets, instead")
+    parser.add_argument("--link-counts", metavar="N", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000],
+                        help="numbers of links with --links (default: 10 100 1000 10000 100000)")
+    parser.add_argument("--compare", metavar="MARKDOWN2_PY", action="append", default=[],
+                        help="also benchmark this markdown2.py with --scaling, --links or --import-time")
+    parser.add_argument("--import-time", action="store_true",
+                        help="benchmark importing markdown2 in a fresh interpreter instead")
+    parser.add_argument("--runs", metavar="N", type=int, default=20,
+                        help="number of interpreters to time with --import-time (default: 20)")
+    args = parser.parse_args()
+
+    if args.scaling:
+        benchmark_scaling(args.sizes, args.seed, [os.path.join(HERE, "markdown2.py")] + args.compare)
+        sys.exit()
+    if args.links:
+        benchmark_links(args.link_counts, args.seed, [os.path.join(HERE, "markdown2.py")] + args.compare)
+        sys.exit()
+    if args.import_time:
+        benchmark_import([os.path.join(HERE, "markdown2.py")] + args.compare, args.runs, args.seed)
+        sys.exit()
+
+    root = args.dir or tempfile.mkdtemp(prefix="mublog-bench-")
+    results = {}
+    sites = []
+    try:
+        for posts in args.posts:
+            sites.append(os.path.join(root, f"site-{posts}"))
+            results[posts] = benchmark(sites[-1], posts, args.seed, args.jobs)
+    finally:
+        if not args.keep:
+            # A directory given with --dir is the user's: only the sites are removed from it.
+            for site in sites if args.dir else [root]:
+                shutil.rmtree(site, ignore_errors=True)
+
+    print_stages(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"jobs": args.jobs, "seed": args.seed, "results": results}, f, indent=1)
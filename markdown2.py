@@ -103,14 +103,19 @@ __version_info__ = (2, 4, 9)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Trent Mick"
 
-import argparse
 import codecs
+import copy
+import functools
 import logging
+import os
 import re
 import sys
-from collections import defaultdict
-from hashlib import sha256
-from random import randint, random
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from itertools import islice
+from random import getrandbits, random
 
 # ---- globals
 
@@ -120,33 +125,70 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-# MD5 function was previously used for this; the "md5" prefix was kept for
-# backwards compatibility.
-def _hash_text(s):
-    return 'md5-' + sha256(SECRET_SALT + s.encode("utf-8")).hexdigest()[32:]
-
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+# Text that must be protected from further processing is replaced by a
+# placeholder, and swapped back in at the end. Placeholders keep the shape of
+# the MD5 hashes used for this originally -- "md5-" and 32 hex digits -- which
+# some of the regexes below rely on. The first 16 digits are random, so that
+# the text can't contain a placeholder by accident, and the last 16 are a
+# serial number.
+_PLACEHOLDER_PREFIX = 'md5-%016x' % getrandbits(64)
+def _placeholder(serial):
+    return '%s%016x' % (_PLACEHOLDER_PREFIX, serial)
+_placeholder_re = re.compile(re.escape(_PLACEHOLDER_PREFIX) + '[0-9a-f]{16}')
+
+# Table of placeholders for escaped characters. Their serial numbers count
+# down from the top, while those issued during a conversion count up from 0.
+g_escape_table = dict([(ch, _placeholder(0xffffffffffffffff - i))
+    for i, ch in enumerate('\\`*_{}[]()>#+-.!')])
+g_smarty_escape_table = {'"': _placeholder(0xffffffffffffff00),
+                         "'": _placeholder(0xffffffffffffff01)}
 
 # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
 #   http://bumppo.net/projects/amputator/
 _AMPERSAND_RE = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
 
 
+class _LazyRegex(object):
+    """A regex of a class, compiled when it is first used.
+
+    Most of the regexes of `Markdown` are only used by some extras, and
+    compiling all of them would make importing markdown2 much slower.
+    Once compiled, the regex replaces this in the class.
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        regex = re.compile(self.pattern, self.flags)
+        setattr(self.owner, self.name, regex)
+        return regex
+
+
 # ---- exceptions
 class MarkdownError(Exception):
     pass
 
 
+class MarkdownTimeoutError(MarkdownError):
+    """Raised when a conversion takes longer than the `time_budget` of
+    its converter.
+    """
+    pass
+
+
 # ---- public api
 
 def markdown_path(path, encoding="utf-8",
                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                   safe_mode=None, extras=None, link_patterns=None,
                   footnote_title=None, footnote_return_symbol=None,
-                  use_file_vars=False):
+                  use_file_vars=False, highlight_cache=None, time_budget=None,
+                  span_engine="regex"):
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
@@ -155,19 +197,26 @@ def markdown_path(path, encoding="utf-8",
                     link_patterns=link_patterns,
                     footnote_title=footnote_title,
                     footnote_return_symbol=footnote_return_symbol,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    highlight_cache=highlight_cache,
+                    time_budget=time_budget,
+                    span_engine=span_engine).convert(text)
 
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              footnote_title=None, footnote_return_symbol=None,
-             use_file_vars=False, cli=False):
+             use_file_vars=False, cli=False, highlight_cache=None,
+             time_budget=None, span_engine="regex"):
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
                     footnote_title=footnote_title,
                     footnote_return_symbol=footnote_return_symbol,
-                    use_file_vars=use_file_vars, cli=cli).convert(text)
+                    use_file_vars=use_file_vars, cli=cli,
+                    highlight_cache=highlight_cache,
+                    time_budget=time_budget,
+                    span_engine=span_engine).convert(text)
 
 
 class Markdown(object):
@@ -188,16 +237,20 @@ class Markdown(object):
 
     _toc = None
 
+    # When a conversion with a `time_budget` has to be done by.
+    _deadline = None
+
     # Used to track when we're inside an ordered or unordered list
     # (see _ProcessListItems() for details):
     list_level = 0
 
-    _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _ws_only_line_re = _LazyRegex(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
                  extras=None, link_patterns=None,
                  footnote_title=None, footnote_return_symbol=None,
-                 use_file_vars=False, cli=False):
+                 use_file_vars=False, cli=False, block_cache=None,
+                 highlight_cache=None, time_budget=None, span_engine="regex"):
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -249,14 +302,30 @@ class Markdown(object):
         self.use_file_vars = use_file_vars
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
         self.cli = cli
-
-        self._escape_table = g_escape_table.copy()
-        self._code_table = {}
+        self.block_cache = block_cache
+        self.highlight_cache = highlight_cache
+        # Seconds a conversion may take, or None.
+        self.time_budget = time_budget
+        # How the span-level transformations are run: "regex" runs all of
+        # them on each span of text, "scan" only those that can change it.
+        if span_engine not in ("regex", "scan"):
+            raise MarkdownError("Unknown span engine %r: use 'regex' or 'scan'" % (span_engine,))
+        self.span_engine = span_engine
+
+        self._instance_escape_table = g_escape_table.copy()
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            self._instance_escape_table.update(g_smarty_escape_table)
+        self._escape_table = self._instance_escape_table.copy()
+        self._code_table = {}
+        self._placeholders = self._instance_escape_table.copy()
+        self._placeholder_serial = len(self._placeholders)
+        self._list_res = {}
 
     def reset(self):
+        self._escape_table = self._instance_escape_table.copy()
+        self._code_table = {}
+        self._placeholders = self._instance_escape_table.copy()
+        self._placeholder_serial = len(self._placeholders)
         self.urls = {}
         self.titles = {}
         self.html_blocks = {}
@@ -266,6 +335,21 @@ class Markdown(object):
         self._setup_extras()
         self._toc = None
 
+    def _hash_text(self, s):
+        """Return the placeholder for `s`.
+
+        The placeholder is the same for all occurrences of `s` during a
+        conversion, as it was when it was a hash of `s`, including the
+        escaped characters, which start out with theirs. The serials aren't
+        reused, even if the text is forgotten (see `_paragraphs_by_block()`).
+        """
+        try:
+            return self._placeholders[s]
+        except KeyError:
+            key = self._placeholders[s] = _placeholder(self._placeholder_serial)
+            self._placeholder_serial += 1
+            return key
+
     def _setup_extras(self):
         if "footnotes" in self.extras:
             self.footnotes = {}
@@ -281,7 +365,7 @@ class Markdown(object):
     # Opens the linked document in a new window or tab
     # should only used in <a> tags with an "href" attribute.
     # same with _a_nofollow
-    _a_nofollow_or_blank_links = re.compile(r"""
+    _a_nofollow_or_blank_links = _LazyRegex(r"""
         <(a)
         (
             [^>]*
@@ -294,7 +378,75 @@ class Markdown(object):
     )
 
     def convert(self, text):
-        """Convert the given text."""
+        """Convert the given text.
+
+        The conversion is done on a copy of the converter (see
+        `_document()`), so the same converter can convert texts in
+        several threads at once, or convert another text while
+        converting one. Its results (`metadata`, `footnotes`, the
+        table of contents, etc.) are then copied to the converter, as
+        they always were; with several threads, read them from the
+        returned string instead.
+        """
+        doc = self._document()
+        text = "".join(doc._convert_to_chunks(text))
+        self._keep_results(doc)
+
+        # Attach attrs to output
+        rv = UnicodeWithAttrs(text)
+
+        if "toc" in doc.extras and doc._toc:
+            rv.toc_html = doc._toc_html
+
+        if "metadata" in doc.extras:
+            rv.metadata = doc.metadata
+        return rv
+
+    def convert_to(self, stream, text):
+        """Convert the given text, and write the html to `stream`.
+
+        The html is the same as that returned by `convert()`, but it is
+        written a block at a time, as the blocks are finished, rather
+        than collected in one string first. Returns the metadata of the
+        text with the "metadata" extra, else None.
+
+        The text is split into top-level blocks once the html blocks and
+        link definitions are taken out of it (see `_split_blocks()`), and
+        the blocks are converted and written one after the other, so only
+        the html of one is held at a time. The whole document is converted
+        before anything is written with a `block_cache`, safe mode, a
+        `postprocess()` override, the "nofollow" or "target-blank-links"
+        extras, as these work on the html as a whole, or with the "toc"
+        extra in `cli` mode, as the table of contents goes first.
+        """
+        doc = self._document()
+        for chunk in doc._convert_to_chunks(text, lazy=True):
+            stream.write(chunk)
+        self._keep_results(doc)
+        return doc.metadata if "metadata" in doc.extras else None
+
+    def _document(self):
+        """Return a converter for one text: a shallow copy of this one,
+        sharing its options, with the per-document state (link
+        definitions, hashed html, footnotes, metadata, etc.) of its own.
+        """
+        doc = copy.copy(self)
+        doc.reset()
+        return doc
+
+    # The per-document state that is the result of a conversion.
+    _results = ("urls", "titles", "footnotes", "footnote_ids", "metadata",
+                "_toc", "_toc_html")
+
+    def _keep_results(self, doc):
+        """Copy the results of the conversion done by `doc` (see
+        `_document()`) to this converter.
+        """
+        for name in self._results:
+            if name in doc.__dict__:
+                setattr(self, name, doc.__dict__[name])
+
+    def _convert_to_chunks(self, text, lazy=False):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
@@ -303,8 +455,9 @@ class Markdown(object):
         # Clear the global hashes. If we don't clear these, you get conflicts
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
-        # articles):
-        self.reset()
+        # articles). This is done by `_document()`.
+        if self.time_budget is not None:
+            self._deadline = time.perf_counter() + self.time_budget
 
         if not isinstance(text, str):
             # TODO: perhaps shouldn't presume UTF-8 for string input?
@@ -349,6 +502,39 @@ class Markdown(object):
         if "metadata" in self.extras:
             text = self._extract_metadata(text)
 
+        if self._use_block_cache():
+            blocks = iter(self._convert_blocks(text))
+        else:
+            blocks = self._convert_body_to_blocks(text, lazy=lazy)
+
+        if "toc" in self.extras and self.cli:
+            # Prepend toc html to output, once the whole document is
+            # converted.
+            blocks = iter(list(blocks))
+            if self._toc:
+                self._toc_html = calculate_toc_html(self._toc)
+                yield self._toc_html + "\n"
+
+        yield next(blocks, "")
+        for block in blocks:
+            yield "\n\n"
+            yield block
+        yield "\n"
+
+        if "toc" in self.extras and self._toc:
+            self._toc_html = calculate_toc_html(self._toc)
+
+    def _convert_body(self, text, link_defs=None):
+        """The html of `_convert_body_to_blocks()` in one string."""
+        return "\n\n".join(self._convert_body_to_blocks(text, link_defs))
+
+    def _convert_body_to_blocks(self, text, link_defs=None, lazy=False):
+        """Convert the text, once it is standardized and any metadata is
+        stripped, generating the html of each top-level block in turn.
+
+        With `lazy`, the block gamut is run on each top-level block of the
+        text in turn, as its html is asked for, rather than on the whole.
+        """
         text = self.preprocess(text)
 
         if 'wavedrom' in self.extras:
@@ -384,49 +570,87 @@ class Markdown(object):
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
-
-        text = self._run_block_gamut(text)
-
-        if "footnotes" in self.extras:
-            text = self._add_footnotes(text)
-
-        text = self.postprocess(text)
-
-        text = self._unescape_special_chars(text)
-
-        if self.safe_mode:
-            text = self._unhash_html_spans(text)
-            # return the removed text warning to its markdown.py compatible form
-            text = text.replace(self.html_removed_text, self.html_removed_text_compat)
+        if link_defs is not None:
+            # A block converted on its own: its links may refer to the
+            # definitions in the rest of the document (see `_convert_blocks()`).
+            self.urls = _LinkDefs(self.urls, link_defs[0])
+            self.titles = _LinkDefs(self.titles, link_defs[1])
+            if not text.strip():
+                return
 
         do_target_blank_links = "target-blank-links" in self.extras
         do_nofollow_links = "nofollow" in self.extras
+        # Postprocessing, unhashing the html spans one by one, and rewriting
+        # the links, are done on the html as a whole, as they can match
+        # across blocks.
+        whole_html = (self.safe_mode or do_target_blank_links or do_nofollow_links
+                      or type(self).postprocess is not Markdown.postprocess)
+
+        by_block = lazy and not whole_html
+        if by_block:
+            grafs = self._paragraphs_by_block(text)
+            del text
+        else:
+            grafs = self._run_block_gamut_to_paragraphs(text)
+            if "footnotes" in self.extras:
+                self._add_footnotes(grafs)
+            if whole_html:
+                grafs = ["\n\n".join(grafs)]
+            unescape_special_chars = self._special_chars_unescaper()
+
+        for i, text in enumerate(grafs):
+            if by_block:
+                # Only the special chars hidden in the block are left.
+                unescape_special_chars = self._special_chars_unescaper()
+            else:
+                # Only hold on to the html of the blocks not yet generated.
+                grafs[i] = None
+            self._check_time_budget()
 
-        if do_target_blank_links and do_nofollow_links:
-            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow noopener" target="_blank"\2', text)
-        elif do_target_blank_links:
-            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="noopener" target="_blank"\2', text)
-        elif do_nofollow_links:
-            text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow"\2', text)
-
-        if "toc" in self.extras and self._toc:
-            self._toc_html = calculate_toc_html(self._toc)
-
-            # Prepend toc html to output
-            if self.cli:
-                text = '{}\n{}'.format(self._toc_html, text)
-
-        text += "\n"
-
-        # Attach attrs to output
-        rv = UnicodeWithAttrs(text)
+            text = self.postprocess(text)
 
-        if "toc" in self.extras and self._toc:
-            rv.toc_html = self._toc_html
+            text = unescape_special_chars(text)
 
-        if "metadata" in self.extras:
-            rv.metadata = self.metadata
-        return rv
+            if self.safe_mode:
+                text = self._unhash_html_spans(text)
+                # return the removed text warning to its markdown.py compatible form
+                text = text.replace(self.html_removed_text, self.html_removed_text_compat)
+
+            if do_target_blank_links and do_nofollow_links:
+                text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow noopener" target="_blank"\2', text)
+            elif do_target_blank_links:
+                text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="noopener" target="_blank"\2', text)
+            elif do_nofollow_links:
+                text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow"\2', text)
+
+            yield text
+
+    def _paragraphs_by_block(self, text):
+        """Generate the paragraphs of `_run_block_gamut_to_paragraphs()`,
+        and the footnotes, running the block gamut on each top-level block
+        of the text in turn (see `_split_blocks()`).
+
+        Once the paragraphs of a block are taken, the text hashed while
+        converting it is forgotten: it is only referred to in their html.
+        """
+        tables = [self._placeholders, self._escape_table, self._code_table,
+                  self.html_blocks, self.html_spans]
+        empty = True
+        for block in self._split_blocks(text):
+            empty = False
+            sizes = [len(table) for table in tables]
+            yield from self._run_block_gamut_to_paragraphs(block + "\n\n")
+            # The tables keep the order in which the text was hashed.
+            for table, size in zip(tables, sizes):
+                for key in list(islice(reversed(table), len(table) - size)):
+                    del table[key]
+        if empty:
+            # A text without any blocks still makes an (empty) paragraph.
+            yield from self._run_block_gamut_to_paragraphs(text)
+        if "footnotes" in self.extras:
+            grafs = []
+            self._add_footnotes(grafs)
+            yield from grafs
 
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
@@ -454,7 +678,7 @@ class Markdown(object):
     #   another-var: blah blah
     #
     #   # header
-    _meta_data_pattern = re.compile(r'''
+    _meta_data_pattern = _LazyRegex(r'''
         ^{0}(  # optional opening fence
             (?:
                 {1}:(?:\n+[ \t]+.*)+  # indented lists
@@ -468,15 +692,15 @@ class Markdown(object):
         '''.format(r'(?:---[\ \t]*\n)?', r'[\S \t]*\w[\S \t]*\s*'), re.MULTILINE | re.VERBOSE
     )
 
-    _key_val_list_pat = re.compile(
+    _key_val_list_pat = _LazyRegex(
         r"^-(?:[ \t]*([^\n]*)(?:[ \t]*[:-][ \t]*(\S+))?)(?:\n((?:[ \t]+[^\n]+\n?)+))?",
         re.MULTILINE,
     )
-    _key_val_dict_pat = re.compile(
+    _key_val_dict_pat = _LazyRegex(
         r"^([^:\n]+)[ \t]*:[ \t]*([^\n]*)(?:((?:\n[ \t]+[^\n]+)+))?", re.MULTILINE
     )  # grp0: key, grp1: value, grp2: multiline value
-    _meta_data_fence_pattern = re.compile(r'^---[\ \t]*\n', re.MULTILINE)
-    _meta_data_newline = re.compile("^\n", re.MULTILINE)
+    _meta_data_fence_pattern = _LazyRegex(r'^---[\ \t]*\n', re.MULTILINE)
+    _meta_data_newline = _LazyRegex("^\n", re.MULTILINE)
 
     def _extract_metadata(self, text):
         if text.startswith("---"):
@@ -549,7 +773,7 @@ class Markdown(object):
 
         return tail
 
-    _emacs_oneliner_vars_pat = re.compile(r"((?:<!--)?\s*-\*-)\s*(?:(\S[^\r\n]*?)([\r\n]\s*)?)?(-\*-\s*(?:-->)?)", re.UNICODE)
+    _emacs_oneliner_vars_pat = _LazyRegex(r"((?:<!--)?\s*-\*-)\s*(?:(\S[^\r\n]*?)([\r\n]\s*)?)?(-\*-\s*(?:-->)?)", re.UNICODE)
     # This regular expression is intended to match blocks like this:
     #    PREFIX Local Variables: SUFFIX
     #    PREFIX mode: Tcl SUFFIX
@@ -558,7 +782,7 @@ class Markdown(object):
     # - "[ \t]" is used instead of "\s" to specifically exclude newlines
     # - "(\r\n|\n|\r)" is used instead of "$" because the sre engine does
     #   not like anything other than Unix-style line terminators.
-    _emacs_local_vars_pat = re.compile(r"""^
+    _emacs_local_vars_pat = _LazyRegex(r"""^
         (?P<prefix>(?:[^\r\n|\n|\r])*?)
         [\ \t]*Local\ Variables:[\ \t]*
         (?P<suffix>.*?)(?:\r\n|\n|\r)
@@ -676,15 +900,13 @@ class Markdown(object):
         return emacs_vars
 
     def _detab_line(self, line):
-        r"""Recusively convert tabs to spaces in a single line.
+        r"""Convert tabs to spaces in a single line.
 
         Called from _detab()."""
-        if '\t' not in line:
-            return line
-        chunk1, chunk2 = line.split('\t', 1)
-        chunk1 += (' ' * (self.tab_width - len(chunk1) % self.tab_width))
-        output = chunk1 + chunk2
-        return self._detab_line(output)
+        return line.expandtabs(self.tab_width)
+
+    # The line boundaries of str.splitlines() other than "\n".
+    _other_line_breaks_re = _LazyRegex('[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
 
     def _detab(self, text):
         r"""Iterate text line by line and convert tabs to spaces.
@@ -700,13 +922,22 @@ class Markdown(object):
             '  foo'
             >>> m._detab("  foo\n\tbar\tblam")
             '  foo\n    bar blam'
+
+        Each tab pads the text before it in the line to the next multiple
+        of the tab width. A text with tabs is split into lines as by
+        str.splitlines(), and joined with "\n":
+
+            >>> m._detab("a\tb\r\n\tc\x0cd\te")
+            'a   b\n    c\nd   e'
         """
         if '\t' not in text:
             return text
-        output = []
-        for line in text.splitlines():
-            output.append(self._detab_line(line))
-        return '\n'.join(output)
+        if self._other_line_breaks_re.search(text):
+            return '\n'.join(self._detab_line(line) for line in text.splitlines())
+        # With "\n" the only line break, str.expandtabs() restarts the
+        # columns at the same places as splitting the text into lines does.
+        text = text.expandtabs(self.tab_width)
+        return text[:-1] if text.endswith('\n') else text
 
     # I broke out the html5 tags here and add them to _block_tags_a and
     # _block_tags_b.  This way html5 tags are easy to keep track of.
@@ -715,7 +946,7 @@ class Markdown(object):
     _block_tags_a = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math|ins|del'
     _block_tags_a += _html5tags
 
-    _strict_tag_block_re = re.compile(r"""
+    _strict_tag_block_re = _LazyRegex(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -731,7 +962,7 @@ class Markdown(object):
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
     _block_tags_b += _html5tags
 
-    _liberal_tag_block_re = re.compile(r"""
+    _liberal_tag_block_re = _LazyRegex(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -744,7 +975,7 @@ class Markdown(object):
         """ % _block_tags_b,
         re.X | re.M)
 
-    _html_markdown_attr_re = re.compile(
+    _html_markdown_attr_re = _LazyRegex(
         r'''\s+markdown=("1"|'1')''')
     def _hash_html_block_sub(self, match, raw=False):
         if isinstance(match, str):
@@ -762,14 +993,14 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -815,20 +1046,29 @@ class Markdown(object):
 
         # Special case for standalone HTML comments:
         if "<!--" in text:
+            # The hashed comments are collected in `pieces` up to `pos`, and
+            # `text` itself is left alone. The search for the next comment
+            # resumes at the same position as when each comment was spliced
+            # into the text: `start`, which is counted in the text with the
+            # comments hashed, `growth` characters longer than `text` so far.
+            pieces = []
+            pos = 0
+            growth = 0
             start = 0
             while True:
                 # Delimiters for next comment block.
                 try:
-                    start_idx = text.index("<!--", start)
+                    start_idx = text.index("<!--", max(start - growth, pos))
                 except ValueError:
                     break
                 try:
                     end_idx = text.index("-->", start_idx) + 3
                 except ValueError:
                     break
+                self._check_time_budget()
 
                 # Start position for next comment block search.
-                start = end_idx
+                start = end_idx + growth
 
                 # Validate whitespace before comment.
                 if start_idx:
@@ -864,9 +1104,16 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
-                text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                pieces.append(text[pos:start_idx])
+                pieces.append("\n\n" + key + "\n\n")
+                growth += len(key) + 4 - (end_idx - start_idx)
+                pos = end_idx
+
+            if pieces:
+                pieces.append(text[pos:])
+                text = ''.join(pieces)
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -894,14 +1141,14 @@ class Markdown(object):
         '''
         tag_count = 0
         current_tag = html_tags_re
-        block = ''
-        result = ''
+        block = []
+        result = []
 
         for chunk in text.splitlines(True):
             is_markup = re.match(
                 r'^(\s{0,%s})(?:</code>(?=</pre>))?(</?(%s)\b>?)' % ('' if allow_indent else '0', current_tag), chunk
             )
-            block += chunk
+            block.append(chunk)
 
             if is_markup:
                 if chunk.startswith('%s</' % is_markup.group(1)):
@@ -917,14 +1164,14 @@ class Markdown(object):
 
             if tag_count == 0:
                 if is_markup:
-                    block = callback(block.rstrip('\n'))  # remove trailing newline
+                    block = [callback(''.join(block).rstrip('\n'))]  # remove trailing newline
                 current_tag = html_tags_re
-                result += block
-                block = ''
+                result.extend(block)
+                block = []
 
-        result += block
+        result.extend(block)
 
-        return result
+        return ''.join(result)
 
     def _tag_is_closed(self, tag_name, text):
         # super basic check if number of open tags == number of closing tags
@@ -974,6 +1221,295 @@ class Markdown(object):
             self.titles[key] = title
         return ""
 
+    # Extras whose output for a block depends on the rest of the document,
+    # e.g. on the numbers of the footnotes or headers before it.
+    _block_cache_excluded_extras = frozenset(
+        ['footnotes', 'header-ids', 'toc', 'numbering', 'markdown-in-html'])
+
+    def _use_block_cache(self):
+        return (self.block_cache is not None
+                and not self.safe_mode
+                and not self.use_file_vars
+                and self._block_cache_excluded_extras.isdisjoint(self.extras)
+                and type(self).preprocess is Markdown.preprocess
+                and type(self).postprocess is Markdown.postprocess)
+
+    def _convert_blocks(self, text):
+        """Convert the text block by block, reusing the html of the blocks
+        in `self.block_cache`, and return the html of each.
+
+        The html of a block is cached along with the link definitions in
+        it, and those it looked up. It is reused as long as the latter are
+        the same in the document being converted.
+        """
+        cache = self.block_cache
+        config = (type(self), self.tab_width, self.safe_mode,
+                  self.empty_element_suffix,
+                  repr(sorted(self.extras.items(), key=lambda item: item[0])),
+                  repr(self.link_patterns))
+        metadata = self.metadata if "metadata" in self.extras else None
+
+        # Convert the blocks missing from the cache first, to find their link
+        # definitions, then those whose links refer to the other blocks again.
+        hits = misses = 0
+        blocks = []
+        for block_text in self._split_blocks(text):
+            key = (config, block_text)
+            block = cache._get(key)
+            if block is None:
+                block = self._convert_block(block_text, {}, {}, metadata)
+                misses += 1
+                blocks.append((key, block, False))
+            else:
+                blocks.append((key, block, True))
+        urls = {}
+        titles = {}
+        for key, block, cached in blocks:
+            urls.update(block.urls)
+            titles.update(block.titles)
+
+        html = []
+        for key, block, cached in blocks:
+            if not block.is_current(urls, titles):
+                block = self._convert_block(key[1], urls, titles, metadata)
+                if cached:
+                    misses += 1
+            elif cached:
+                hits += 1
+            cache._put(key, block)
+            if block.html:
+                html.append(block.html)
+        cache._count(hits, misses)
+
+        self.reset()
+        if metadata is not None:
+            self.metadata = metadata
+        if not html:
+            # The document is empty, apart from any link definitions.
+            return list(self._convert_body_to_blocks(text))
+        self.urls = urls
+        self.titles = titles
+        return html
+
+    def _convert_block(self, text, urls, titles, metadata):
+        self.reset()
+        if metadata is not None:
+            self.metadata = metadata
+        html = self._convert_body(text + "\n\n", (urls, titles))
+        return _CachedBlock(self.urls, self.titles, html)
+
+    _blank_lines_re = _LazyRegex(r'(\n{2,})')
+    # The start of a line that continues the block before it, even after
+    # blank lines: indented, a list item, or a quote. So does a link
+    # definition, which is stripped along with the blank lines after it.
+    _block_continuation_re = _LazyRegex(r'\s|[*+-][ ]|\d+\.[ ]|>|[ ]{0,3}\[.+\]:')
+    _link_def_start_re = _LazyRegex(r'^[ ]{0,3}\[.+\]:', re.M)
+    # A list item marker without any text after it. A list starting with
+    # one runs on past the blank lines after it (see `_whole_list_pat()`),
+    # and the html of a list ending with one isn't balanced, so that html
+    # blocks hashed after it can reach any further into the text.
+    _empty_list_item_re = _LazyRegex(r'^[ ]*(?:[*+-]|\d+\.)[ ]+$', re.M)
+    _pyshell_start_re = _LazyRegex(r'^[ ]{0,3}>>>[ ]', re.M)
+    _liberal_start_re = _LazyRegex(r'<(%s)\b' % _block_tags_b)
+    _liberal_end_re = _LazyRegex(r'</(%s)>[ \t]*$' % _block_tags_b)
+
+    def _split_blocks(self, text):
+        """Split the text at blank lines into blocks that convert the same
+        on their own as in the document, and generate them in turn.
+
+        A blank line splits blocks unless the line after it continues the
+        block before it, or it is within a block of html (as
+        `_hash_html_blocks()` finds them), a comment or a fenced code block.
+        Nor does one after a list item without text. The html is judged
+        conservatively; a block may be larger than necessary, but never
+        too small.
+        """
+        fences = []
+        converted_fences = []
+        for match in self._fenced_code_block_re.finditer(text):
+            fences.append((match.start(1), match.end()))
+            if self._is_converted_fence(match):
+                converted_fences.append((match.start(1), match.end(),
+                                         self._is_balanced_fence(match)))
+        fence_starts = [start for start, end in fences]
+        def in_fence(pos):
+            i = bisect_right(fence_starts, pos) - 1
+            return i >= 0 and pos < fences[i][1]
+        # Fenced code blocks are converted to html before any html is looked
+        # for. Their html is balanced unless it is indented or a diagram,
+        # and then the html blocks found after it can't be told.
+        converted_starts = [start for start, end, balanced in converted_fences]
+        def converted_fence(pos):
+            i = bisect_right(converted_starts, pos) - 1
+            if i >= 0 and pos < converted_fences[i][1]:
+                return converted_fences[i]
+            return None
+        unbalanced = False
+        # A code block isn't one if the next html after it, perhaps in a later
+        # block or that of a fenced code block, is "</code>" (see
+        # `_do_code_blocks()`).
+        code_end = text.rfind("</code>")
+        if converted_fences:
+            code_end = max(code_end, converted_fences[-1][1])
+        indented = False
+
+        pieces = []
+        # The state of `_strict_tag_block_sub()`, the number of open
+        # tags of each of `_liberal_tag_block_re`, and whether within a
+        # comment.
+        strict_tags = self._block_tags_a
+        strict_count = 0
+        liberal_counts = defaultdict(int)
+        comment = False
+        # A comment is only hashed as a block if it starts a paragraph, and
+        # the first that doesn't stops the search for further ones. The
+        # search resumes as far after a comment as its html is longer than
+        # its placeholder, unknown if the html blocks in or after it were
+        # hashed first.
+        comments_found = True
+        comment_start = 0
+        comment_hashed_html = False
+        skip_until = 0
+        placeholder_length = len(_placeholder(0)) + 4
+        link_def = None
+        code = False
+        empty_item = False
+        pyshell = "pyshell" in self.extras
+        tables = "tables" in self.extras
+        pos = 0
+        for i, piece in enumerate(self._blank_lines_re.split(text)):
+            if i % 2:
+                if pieces:
+                    pieces.append(piece)
+                pos += len(piece)
+                continue
+            if not piece:
+                # The blank lines at the start or end of the text.
+                pieces = pieces[:-1]
+                continue
+            if (pieces and not empty_item and not unbalanced
+                    and not strict_count and not comment and comments_found
+                    and not link_def and not code
+                    and not any(liberal_counts.values())
+                    and not self._block_continuation_re.match(piece)
+                    and not (indented and pos <= code_end)
+                    and pos >= skip_until
+                    and not in_fence(pos - 1)):
+                yield "".join(pieces[:-1])
+                pieces = []
+            pieces.append(piece)
+            link_def = self._link_def_start_re.search(piece)
+            # A code block takes the blank lines around it with it, joining
+            # the lines before and after. So can the underline of a table.
+            last_line = piece[piece.rfind("\n") + 1:]
+            # Once there is an empty list item, the rest of the text is
+            # kept in its block.
+            empty_item = empty_item or self._empty_list_item_re.search(piece)
+            code = (last_line.startswith(self.tab)
+                    or pyshell and self._pyshell_start_re.search(piece)
+                    or tables and "|" in last_line and not last_line.strip(" |:-"))
+
+            line_pos = pos
+            lines = piece.split("\n")
+            for n, line in enumerate(lines):
+                line_start = line_pos
+                line_pos += len(line) + 1
+                fence = converted_fence(line_start)
+                if fence:
+                    if strict_count or not fence[2]:
+                        unbalanced = True
+                    comment_hashed_html |= comment
+                    if skip_until > line_start:
+                        skip_until = float("inf")
+                    continue
+                if line.startswith(self.tab):
+                    indented = True
+                if '<' not in line and not strict_count and not comment:
+                    continue
+
+                # Lines of html blocks are hashed before those of the next
+                # kind are looked for.
+                in_strict = strict_count
+                is_markup = re.match(r'(?:</code>(?=</pre>))?(</?(%s)\b>?)' % strict_tags, line)
+                if is_markup:
+                    in_strict = True
+                    if line.startswith('</'):
+                        strict_count -= 1
+                    elif not self._tag_is_closed(is_markup.group(2), line):
+                        strict_count += 1
+                        strict_tags = is_markup.group(2)
+                    else:
+                        in_strict = strict_count
+                if strict_count == 0:
+                    strict_tags = self._block_tags_a
+                match = self._liberal_start_re.match(line)
+                if in_strict or match or any(liberal_counts.values()):
+                    comment_hashed_html |= comment
+                    if skip_until > line_start:
+                        skip_until = float("inf")
+                if in_strict:
+                    continue
+
+                if match:
+                    tag = match.group(1)
+                    end = "</%s>" % tag
+                    if not (line.rstrip(" \t").endswith(end)
+                            and len(re.findall(r"<%s\b" % tag, line)) == line.count(end)):
+                        liberal_counts[tag] += 1
+                match = self._liberal_end_re.match(line)
+                if match and liberal_counts[match.group(1)]:
+                    liberal_counts[match.group(1)] -= 1
+                in_liberal = any(liberal_counts.values())
+
+                start = 0
+                while True:
+                    if comment:
+                        start = line.find("-->", start)
+                        if start == -1 or in_liberal:
+                            break
+                        comment = False
+                        start += 3
+                        if n < len(lines) - 1 or line[start:].strip(" \t"):
+                            # Not hashed, so the comment may yet end at a
+                            # later "-->".
+                            comments_found = False
+                        elif comment_hashed_html:
+                            skip_until = float("inf")
+                        else:
+                            end = line_pos - 1
+                            skip_until = 2 * end - comment_start - placeholder_length
+                    else:
+                        start = line.find("<!--", start)
+                        if start == -1:
+                            break
+                        indent = line[:start]
+                        if (n or indent.strip(" ") or len(indent) >= self.tab_width
+                                or line_start + start < skip_until):
+                            comments_found = False
+                        comment = True
+                        comment_start = line_start
+                        comment_hashed_html = False
+            pos += len(piece)
+        if pieces:
+            yield "".join(pieces)
+
+    def _is_converted_fence(self, match):
+        if "fenced-code-blocks" in self.extras:
+            return True
+        return "wavedrom" in self.extras and match.group(2) == "wavedrom"
+
+    def _is_balanced_fence(self, match):
+        # Whether the html of a fenced code block is hashed as a block of its
+        # own, with nothing else, by `_hash_html_blocks()`.
+        lexer_name = match.group(2)
+        if lexer_name in ("wavedrom", "mermaid") and lexer_name in self.extras:
+            return False
+        if (lexer_name and "highlightjs-lang" not in self.extras
+                and self._get_pygments_lexer(lexer_name)):
+            # Options like `linenos` add markup of their own.
+            return not self.extras.get("fenced-code-blocks")
+        return not match.group(1)[0].isspace()
+
     def _do_numbering(self, text):
         ''' We handle the special extension for generic numbering for
             tables, figures etc.
@@ -1074,11 +1610,15 @@ class Markdown(object):
             re.X | re.M)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
-    _hr_re = re.compile(r'^[ ]{0,3}([-_*])[ ]{0,2}(\1[ ]{0,2}){2,}$', re.M)
+    _hr_re = _LazyRegex(r'^[ ]{0,3}([-_*])[ ]{0,2}(\1[ ]{0,2}){2,}$', re.M)
 
     def _run_block_gamut(self, text):
+        return "\n\n".join(self._run_block_gamut_to_paragraphs(text))
+
+    def _run_block_gamut_to_paragraphs(self, text):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
+        self._check_time_budget()
 
         if 'admonitions' in self.extras:
             text = self._do_admonitions(text)
@@ -1118,9 +1658,7 @@ class Markdown(object):
         # <p> tags around block-level tags.
         text = self._hash_html_blocks(text)
 
-        text = self._form_paragraphs(text)
-
-        return text
+        return self._form_paragraphs(text)
 
     def _pyshell_block_sub(self, match):
         if "fenced-code-blocks" in self.extras:
@@ -1279,51 +1817,98 @@ class Markdown(object):
             ''' % less_than_tab, re.M | re.X)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
+    def _check_time_budget(self):
+        """Raise MarkdownTimeoutError if the conversion is past its
+        `time_budget`. It is checked before each block and span of text is
+        converted, and at each step of the loops over the links, lists,
+        emphasis and html comments of a text, which may be long.
+        """
+        if self._deadline is not None and time.perf_counter() > self._deadline:
+            raise MarkdownTimeoutError("conversion took longer than its time budget of %gs"
+                                       % self.time_budget)
+
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
+        self._check_time_budget()
+
+        if self.span_engine == "scan":
+            return self._scan_span_gamut(text)
+
+        for chars, transform in self._span_transforms():
+            text = transform(text)
+        return self._do_hard_breaks(text)
 
-        text = self._do_code_spans(text)
+    # The characters the span transformations act on (see
+    # `_span_transforms`).
+    _span_trigger_re = _LazyRegex(r"""[`\\<>&\[*_~|'".-]""")
 
-        text = self._escape_special_chars(text)
+    def _scan_span_gamut(self, text):
+        """The "scan" span engine: `_run_span_gamut` with the transformations
+        that can't change the text skipped.
+
+        The characters the transformations act on are found in a single scan
+        of the text, which is only scanned again when a transformation has
+        changed it. On prose, most spans have none of the characters of most
+        transformations.
+        """
+        found = set(self._span_trigger_re.findall(text))
+        for chars, transform in self._span_transforms():
+            if chars is not None and found.isdisjoint(chars):
+                continue
+            new_text = transform(text)
+            if new_text is not text:
+                text = new_text
+                found = set(self._span_trigger_re.findall(text))
+        return self._do_hard_breaks(text)
+
+    def _span_transforms(self):
+        """The span transformations to run, in order, as
+        `(chars, transform)` pairs: a transformation leaves a text without
+        any of its `chars` unchanged, or `chars` is None.
+        """
+        transforms = [
+            ("`", self._do_code_spans),
+            ("<\\", self._escape_special_chars),
+        ]
 
         # Process anchor and image tags.
         if "link-patterns" in self.extras:
-            text = self._do_link_patterns(text)
-
-        text = self._do_links(text)
+            transforms.append((None, self._do_link_patterns))
+        transforms.append(("[", self._do_links))
 
         # Make links out of things like `<http://example.com/>`
         # Must come after _do_links(), because you can use < and >
         # delimiters in inline links like [this](<url>).
-        text = self._do_auto_links(text)
+        transforms.append(("<", self._do_auto_links))
 
-        text = self._encode_amps_and_angles(text)
+        transforms.append(("&<>", self._encode_amps_and_angles))
 
         if "strike" in self.extras:
-            text = self._do_strike(text)
+            transforms.append(("~", self._do_strike))
 
         if "underline" in self.extras:
-            text = self._do_underline(text)
+            transforms.append(("-", self._do_underline))
 
-        text = self._do_italics_and_bold(text)
+        transforms.append(("*_", self._do_italics_and_bold))
 
         if "tg-spoiler" in self.extras:
-            text = self._do_tg_spoiler(text)
+            transforms.append(("|", self._do_tg_spoiler))
 
         if "smarty-pants" in self.extras:
-            text = self._do_smart_punctuation(text)
+            transforms.append(("'\"-.", self._do_smart_punctuation))
+        return transforms
 
-        # Do hard breaks:
+    def _do_hard_breaks(self, text):
         if "break-on-newline" in self.extras:
-            text = re.sub(r" *\n(?!\<(?:\/?(ul|ol|li))\>)", "<br%s\n" % self.empty_element_suffix, text)
-        else:
+            if "\n" in text:  # guard for perf
+                text = re.sub(r" *\n(?!\<(?:\/?(ul|ol|li))\>)", "<br%s\n" % self.empty_element_suffix, text)
+        elif "  \n" in text:  # guard for perf
             text = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix, text)
-
         return text
 
     # "Sorta" because auto-links are identified as "tag" tokens.
-    _sorta_html_tokenize_re = re.compile(r"""
+    _sorta_html_tokenize_re = _LazyRegex(r"""
         (
             \\*  # escapes
             (?:
@@ -1403,7 +1988,7 @@ class Markdown(object):
         for index, token in enumerate(split_tokens):
             if is_html_markup and not _is_auto_link(token) and not _is_code_span(index, token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1432,7 +2017,7 @@ class Markdown(object):
             raise MarkdownError("invalid value for 'safe_mode': %r (must be "
                                 "'escape' or 'replace')" % self.safe_mode)
 
-    _inline_link_title = re.compile(r'''
+    _inline_link_title = _LazyRegex(r'''
             (                   # \1
               [ \t]+
               (['"])            # quote char = \2
@@ -1441,7 +2026,7 @@ class Markdown(object):
             )?                  # title is optional
           \)$
         ''', re.X | re.S)
-    _tail_of_reference_link_re = re.compile(r'''
+    _tail_of_reference_link_re = _LazyRegex(r'''
           # Match tail of: [text][id]
           [ ]?          # one optional space
           (?:\n[ ]*)?   # one optional newline followed by spaces
@@ -1450,9 +2035,9 @@ class Markdown(object):
           \]
         ''', re.X | re.S)
 
-    _whitespace = re.compile(r'\s*')
+    _whitespace = _LazyRegex(r'\s*')
 
-    _strip_anglebrackets = re.compile(r'<(.*)>.*')
+    _strip_anglebrackets = _LazyRegex(r'<(.*)>.*')
 
     def _find_non_whitespace(self, text, start):
         """Returns the index of the first non-whitespace character in text
@@ -1461,33 +2046,35 @@ class Markdown(object):
         match = self._whitespace.match(text, start)
         return match.end()
 
-    def _find_balanced(self, text, start, open_c, close_c):
+    def _find_balanced(self, text, start, open_c, close_c, balancer=None):
         """Returns the index where the open_c and close_c characters balance
         out - the same number of open_c and close_c are encountered - or the
         end of string if it's reached before the balance point is found.
+
+        `balancer` is the `_Balancer` of the text, if there is one.
         """
-        i = start
-        l = len(text)
-        count = 1
-        while count > 0 and i < l:
-            if text[i] == open_c:
-                count += 1
-            elif text[i] == close_c:
-                count -= 1
-            i += 1
-        return i
-
-    def _extract_url_and_title(self, text, start):
+        if balancer is None:
+            balancer = _Balancer(text)
+        end = balancer.end(start, open_c, close_c)
+        return len(text) if end < 0 else end
+
+    def _extract_url_and_title(self, text, start, balancer=None):
         """Extracts the url and (optional) title from the tail of a link"""
         # text[start] equals the opening parenthesis
         idx = self._find_non_whitespace(text, start+1)
         if idx == len(text):
             return None, None, None
+        if balancer is None:
+            balancer = _Balancer(text)
         end_idx = idx
         has_anglebrackets = text[idx] == "<"
         if has_anglebrackets:
-            end_idx = self._find_balanced(text, end_idx+1, "<", ">")
-        end_idx = self._find_balanced(text, end_idx, "(", ")")
+            end_idx = self._find_balanced(text, end_idx+1, "<", ">", balancer)
+        end_idx = self._find_balanced(text, end_idx, "(", ")", balancer)
+        # The parentheses don't balance out when the text doesn't end with one,
+        # so the title isn't searched for all the way to the end of the text.
+        if not (text.endswith(")", 0, end_idx) or text.endswith(")\n", 0, end_idx)):
+            return None, None, None
         match = self._inline_link_title.search(text, idx, end_idx)
         if not match:
             return None, None, None
@@ -1503,7 +2090,7 @@ class Markdown(object):
         with it (eg: escaping "&" in URL parameters)
         '''
         url = _html_escape_url(url, safe_mode=self.safe_mode)
-        key = _hash_text(url)
+        key = self._hash_text(url)
         self._escape_table[url] = key
         return key
 
@@ -1512,7 +2099,7 @@ class Markdown(object):
     # Original Showdown code copyright (c) 2007 John Fraser
     # Modifications and bugfixes (c) 2009 Dana Robinson
     # Modifications and bugfixes (c) 2009-2014 Stack Exchange Inc.
-    _safe_href = re.compile(r'^((https?|ftp):\/\/|\/|\.|#)[-A-Za-z0-9+&@#\/%?=~_|!:,.;\(\)*[\]$]*$', re.I)
+    _safe_href = _LazyRegex(r'^((https?|ftp):\/\/|\/|\.|#)[-A-Za-z0-9+&@#\/%?=~_|!:,.;\(\)*[\]$]*$', re.I)
 
     def _do_links(self, text):
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
@@ -1530,6 +2117,16 @@ class Markdown(object):
         # pos must be `>= anchor_allowed_pos`.
         anchor_allowed_pos = 0
 
+        # The text is scanned once, from start to end: the html of the links
+        # done, and the text before it (up to `emitted_pos`), is collected in
+        # `pieces`, rather than spliced into the text for each link.
+        pieces = []
+        emitted_pos = 0
+        text_length = len(text)
+        # Where brackets balance out is looked up rather than scanned for, as
+        # there may be no end to them.
+        balancer = _Balancer(text)
+
         curr_pos = 0
         while True:  # Handle the next link.
             # The next '[' is the start of:
@@ -1551,24 +2148,15 @@ class Markdown(object):
                 start_idx = text.index('[', curr_pos)
             except ValueError:
                 break
-            text_length = len(text)
+            self._check_time_budget()
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = balancer.end(start_idx+1, '[', ']') - 1
+            if p < 0 or p >= start_idx + MAX_LINK_TEXT_SENTINEL:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
@@ -1588,7 +2176,11 @@ class Markdown(object):
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
+                    pieces.append(text[emitted_pos:start_idx])
+                    pieces.append(result)
+                    # As if the text after it were moved by the change in length.
+                    anchor_allowed_pos -= len(result) - (p+1 - start_idx)
+                    emitted_pos = curr_pos = p+1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p+1
@@ -1599,7 +2191,7 @@ class Markdown(object):
 
             # Inline anchor or img?
             if text[p:p + 1] == '(':  # attempt at perf improvement
-                url, title, url_end_idx = self._extract_url_and_title(text, p)
+                url, title, url_end_idx = self._extract_url_and_title(text, p, balancer)
                 if url is not None:
                     # Handle an inline anchor or img.
                     is_img = start_idx > 0 and text[start_idx-1] == "!"
@@ -1627,9 +2219,9 @@ class Markdown(object):
                                self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                        pieces.append(text[emitted_pos:start_idx])
+                        pieces.append(result)
+                        emitted_pos = curr_pos = anchor_allowed_pos = url_end_idx
                     elif start_idx >= anchor_allowed_pos:
                         safe_link = self._safe_href.match(url)
                         if self.safe_mode and not safe_link:
@@ -1639,11 +2231,21 @@ class Markdown(object):
                         result = '%s%s</a>' % (result_head, link_text)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                        pieces.append(text[emitted_pos:start_idx])
+                        if result.find('[', len(result_head)) == -1:
+                            pieces.append(result)
+                            emitted_pos = curr_pos = anchor_allowed_pos = url_end_idx
+                        else:
+                            # <img> allowed in the link text, <a> after it: the
+                            # rest of the text starts with the link text, and the
+                            # character before it (which could be the "!" of an img).
+                            rescan_pos = len(result_head) - 1
+                            pieces.append(result[:rescan_pos])
+                            text = balancer.rescan(result[rescan_pos:], url_end_idx)
+                            text_length = len(text)
+                            emitted_pos = 0
+                            curr_pos = 1
+                            anchor_allowed_pos = len(result) - rescan_pos
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1684,8 +2286,11 @@ class Markdown(object):
                                    self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            pieces.append(text[emitted_pos:start_idx])
+                            pieces.append(result)
+                            # As if the text after it were moved by the change in length.
+                            anchor_allowed_pos -= len(result) - (match.end() - start_idx)
+                            emitted_pos = curr_pos = match.end()
                         elif start_idx >= anchor_allowed_pos:
                             if self.safe_mode and not self._safe_href.match(url):
                                 result_head = '<a href="#"%s>' % (title_str)
@@ -1694,11 +2299,21 @@ class Markdown(object):
                             result = '%s%s</a>' % (result_head, link_text)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            pieces.append(text[emitted_pos:start_idx])
+                            if result.find('[', len(result_head)) == -1:
+                                pieces.append(result)
+                                emitted_pos = curr_pos = anchor_allowed_pos = match.end()
+                            else:
+                                # <img> allowed in the link text, <a> after it: the
+                                # rest of the text starts with the link text, and the
+                                # character before it (which could be the "!" of an img).
+                                rescan_pos = len(result_head) - 1
+                                pieces.append(result[:rescan_pos])
+                                text = balancer.rescan(result[rescan_pos:], match.end())
+                                text_length = len(text)
+                                emitted_pos = 0
+                                curr_pos = 1
+                                anchor_allowed_pos = len(result) - rescan_pos
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1710,7 +2325,10 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        if not pieces:
+            return text
+        pieces.append(text[emitted_pos:])
+        return ''.join(pieces)
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1757,8 +2375,8 @@ class Markdown(object):
         )
         '''
 
-    _h_re = re.compile(_h_re_base % '*', re.X | re.M)
-    _h_re_tag_friendly = re.compile(_h_re_base % '+', re.X | re.M)
+    _h_re = _LazyRegex(_h_re_base % '*', re.X | re.M)
+    _h_re_tag_friendly = _LazyRegex(_h_re_base % '+', re.X | re.M)
 
     def _h_sub(self, match):
         if match.group(1) is not None and match.group(3) == "-":
@@ -1828,66 +2446,110 @@ class Markdown(object):
         else:
             return "<%s%s>\n%s</%s>\n\n" % (lst_type, lst_opts, result, lst_type)
 
+    def _whole_list_pat(self, marker_pat, other_marker_pat, group=1):
+        # The pattern of a list, with its groups numbered from `group`.
+        return r'''
+            (                   # \1 = whole list
+              (                 # \2
+                ([ ]{0,%(less_than_tab)d})  # \3 = the indentation level of the list item marker
+                (%(marker_pat)s)  # \4 = first list item marker
+                [ \t]+
+                (?!\ *\%(marker)d\ )  # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+              )
+              (?:.+?)
+              (                 # \5
+                  \Z
+                |
+                  \n{2,}
+                  (?=\S)
+                  (?!           # Negative lookahead for another list item marker
+                    [ \t]*
+                    %(marker_pat)s[ \t]+
+                  )
+                |
+                  \n+
+                  (?=
+                    \%(indent)d  # lookahead for a different style of list item marker
+                    %(other_marker_pat)s[ \t]+
+                  )
+              )
+            )
+        ''' % {'less_than_tab': self.tab_width - 1, 'marker_pat': marker_pat,
+               'other_marker_pat': other_marker_pat, 'indent': group + 2, 'marker': group + 3}
+
+    def _list_re(self, kind):
+        '''Return the regex for finding lists of the given kind:
+
+            "ul", "ol": a list of that type, where it starts
+            "any": a list of either type, where it starts
+            "top", "nested": the next list of either type, at the top
+                level (after a blank line) or nested in a list item (at the
+                start of a line)
+
+        The regexes are compiled on first use, and kept by the converter
+        for its tab width.
+        '''
+        key = (self.tab_width, kind)
+        try:
+            return self._list_res[key]
+        except KeyError:
+            pass
+        ul = self._whole_list_pat(self._marker_ul, self._marker_ol)
+        ol = self._whole_list_pat(self._marker_ol, self._marker_ul)
+        # Both types in one pattern, so that the first list of either is
+        # found in a single scan. The groups of ol come after those of ul.
+        either = '(?:%s|%s)' % (ul, self._whole_list_pat(self._marker_ol, self._marker_ul, group=6))
+        pat = {
+            'ul': ul,
+            'ol': ol,
+            'any': either,
+            'top': r"(?:(?<=\n\n)|\A\n?)" + either,
+            'nested': "^" + either,
+        }[kind]
+        list_re = self._list_res[key] = re.compile(pat, re.X | re.M | re.S)
+        return list_re
+
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match. The html of each
+        # list is collected in `pieces` rather than spliced into `text`, so
+        # the matching goes on in the original text, from the end of the
+        # last list.
+        pieces = []
         pos = 0
+        list_re = self._list_re('nested' if self.list_level else 'top')
         while True:
-            # Find the *first* hit for either list style (ul or ol). We
-            # match ul and ol separately to avoid adjacent lists of different
-            # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                other_marker_pat = self._marker_ul if marker_pat == self._marker_ol else self._marker_ol
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        ([ ]{0,%d})     # \3 = the indentation level of the list item marker
-                        (%s)            # \4 = first list item marker
-                        [ \t]+
-                        (?!\ *\4\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \5
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                        |
-                          \n+
-                          (?=
-                            \3          # lookahead for a different style of list item marker
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat, other_marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
+            # Find the *first* hit for either list style (ul or ol). The
+            # patterns of ul and ol are separate alternatives, to avoid
+            # adjacent lists of different types running into each other
+            # (see issue #16).
+            if pieces:
+                # The html of the last list ends with a newline (two at the
+                # top level), so another list can follow it right away,
+                # even where the text it replaced ends with a single one.
+                match = (self._list_re('any').match(text, pos)
+                         or list_re.search(text, pos + 1))
+            else:
                 match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
-            if not hits:
+            if not match:
                 break
-            hits.sort()
-            match = hits[0][1]
+            self._check_time_budget()
             start, end = match.span()
-            middle = self._list_sub(match)
-            text = text[:start] + middle + text[end:]
-            pos = start + len(middle)  # start pos for next attempted match
+            if match.group(1) is not None:
+                list_match = self._list_re('ul').match(text, match.start(1))
+            else:
+                list_match = self._list_re('ol').match(text, match.start(6))
+            pieces.append(text[pos:start])
+            pieces.append(self._list_sub(list_match))
+            pos = end  # start pos for next attempted match
 
-        return text
+        if not pieces:
+            return text
+        pieces.append(text[pos:])
+        return ''.join(pieces)
 
-    _list_item_re = re.compile(r'''
+    _list_item_re = _LazyRegex(r'''
         (\n)?                   # leading line = \1
         (^[ \t]*)               # leading whitespace = \2
         (?P<marker>%s) [ \t]+   # list marker = \3
@@ -1897,7 +2559,7 @@ class Markdown(object):
         ''' % (_marker_any, _marker_any),
         re.M | re.X | re.S)
 
-    _task_list_item_re = re.compile(r'''
+    _task_list_item_re = _LazyRegex(r'''
         (\[[\ xX]\])[ \t]+       # tasklist marker = \1
         (.*)                   # list item text = \2
     ''', re.M | re.X | re.S)
@@ -1964,47 +2626,23 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _get_pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
         import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def _add_newline(self, inner):
-                # Add newlines around the inner contents so that _strict_tag_block_re matches the outer div.
-                yield 0, "\n"
-                yield from inner
-                yield 0, "\n"
-
-            def wrap(self, source, outfile=None):
-                """Return the source with a code, pre, and div."""
-                if outfile is None:
-                    # pygments >= 2.12
-                    return self._add_newline(self._wrap_pre(self._wrap_code(source)))
-                else:
-                    # pygments < 2.12
-                    return self._wrap_div(self._add_newline(self._wrap_pre(self._wrap_code(source))))
 
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        cache = self.highlight_cache
+        if cache is not None:
+            key = cache._key(codeblock, lexer, formatter_opts)
+            html = cache._get(key)
+            if html is not None:
+                return html
+        formatter = _html_code_formatter_class()(**formatter_opts)
+        html = pygments.highlight(codeblock, lexer, formatter)
+        if cache is not None:
+            cache._put(key, html)
+        return html
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -2115,7 +2753,7 @@ class Markdown(object):
             re.M | re.X)
         return code_block_re.sub(self._code_block_sub, text)
 
-    _fenced_code_block_re = re.compile(r'''
+    _fenced_code_block_re = _LazyRegex(r'''
         (?:\n+|\A\n?|(?<=\n))
         (^[ \t]*`{3,})\s{0,99}?([\w+-]+)?\s{0,99}?\n  # $1 = opening fence (captured for back-referencing), $2 = optional lang
         (.*?)                             # $3 = code block content
@@ -2137,7 +2775,7 @@ class Markdown(object):
     #   space and that space will be removed in the emitted HTML
     # See `test/tm-cases/escapes.text` for a number of edge-case
     # examples.
-    _code_span_re = re.compile(r'''
+    _code_span_re = _LazyRegex(r'''
             (?<!\\)
             (`+)        # \1 = Opening run of `
             (?!`)       # See Note A test/tm-cases/escapes.text
@@ -2192,7 +2830,7 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
+        hashed = self._hash_text(text)
         self._code_table[text] = hashed
         return hashed
 
@@ -2222,7 +2860,7 @@ class Markdown(object):
                 pass
 
         # hash SVG to prevent <> chars being messed with
-        self._escape_table[waves] = _hash_text(waves)
+        self._escape_table[waves] = self._hash_text(waves)
 
         return self._uniform_indent(
             '\n%s%s%s\n' % (open_tag, self._escape_table[waves], close_tag),
@@ -2233,7 +2871,7 @@ class Markdown(object):
         return self._fenced_code_block_re.sub(self._wavedrom_block_sub, text)
 
     _admonitions = r'admonition|attention|caution|danger|error|hint|important|note|tip|warning'
-    _admonitions_re = re.compile(r'''
+    _admonitions_re = _LazyRegex(r'''
         ^(\ *)\.\.\ (%s)::\ *                # $1 leading indent, $2 the admonition
         (.*)?                                # $3 admonition title
         ((?:\s*\n\1\ {3,}.*)+?)              # $4 admonition body (required)
@@ -2270,40 +2908,152 @@ class Markdown(object):
     def _do_admonitions(self, text):
         return self._admonitions_re.sub(self._do_admonitions_sub, text)
 
-    _strike_re = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~", re.S)
+    # The span extras below, and emphasis, find each span with a scan for
+    # its opening delimiter, and for the first closing one after it (see
+    # `_sub_spans()`). They find the same spans as these regexes did,
+    # applied with `re.sub()`:
+    #
+    #   strike:      ~~(?=\S)(.+?)(?<=\S)~~
+    #   underline:   (?<!<!)--(?!>)(?=\S)(.+?)(?<=\S)(?<!<!)--(?!>)
+    #   tg-spoiler:  \|\|\s?(.+?)\s?\|\|
+    #   strong:      (\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1
+    #   em:          (\*|_)(?=\S)(.+?)(?<=\S)\1
+    #
+    # but without searching the rest of the text again for each opening
+    # delimiter that isn't closed, which took quadratic time.
+    _strike_open_re = _LazyRegex(r"~~(?=\S)")
+    _strike_close_re = _LazyRegex(r"(?<=\S)~~")
     def _do_strike(self, text):
-        text = self._strike_re.sub(r"<s>\1</s>", text)
-        return text
+        closers = _NextMatch(self._strike_close_re, text)
+
+        def find_span(match):
+            close = closers.start(match.end() + 1)
+            if close < 0:
+                return None
+            return match.end(), close, close + 2
+        return self._sub_spans(text, self._strike_open_re, find_span, "<s>", "</s>")
 
-    _underline_re = re.compile(r"(?<!<!)--(?!>)(?=\S)(.+?)(?<=\S)(?<!<!)--(?!>)", re.S)
+    _underline_open_re = _LazyRegex(r"(?<!<!)--(?!>)(?=\S)")
+    _underline_close_re = _LazyRegex(r"(?<=\S)(?<!<!)--(?!>)")
     def _do_underline(self, text):
-        text = self._underline_re.sub(r"<u>\1</u>", text)
-        return text
+        closers = _NextMatch(self._underline_close_re, text)
+
+        def find_span(match):
+            close = closers.start(match.end() + 1)
+            if close < 0:
+                return None
+            return match.end(), close, close + 2
+        return self._sub_spans(text, self._underline_open_re, find_span, "<u>", "</u>")
 
-    _tg_spoiler_re = re.compile(r"\|\|\s?(.+?)\s?\|\|", re.S)
+    _tg_spoiler_delimiter_re = _LazyRegex(r"\|\|")
     def _do_tg_spoiler(self, text):
-        text = self._tg_spoiler_re.sub(r"<tg-spoiler>\1</tg-spoiler>", text)
-        return text
+        closers = _NextMatch(self._tg_spoiler_delimiter_re, text)
+
+        def find_span(match):
+            start = match.end()
+            close = closers.start(start + 1)
+            if close < 0:
+                return None
+            if text[start].isspace():
+                # Whitespace after the opening delimiter is left out of the
+                # text, unless it is all of the text.
+                if close == start + 1:
+                    later = closers.start(start + 2)
+                    if later >= 0:
+                        start, close = start + 1, later
+                else:
+                    start += 1
+            end = close + 2
+            if close - 1 > start and text[close - 1].isspace():
+                close -= 1
+            return start, close, end
+        return self._sub_spans(text, self._tg_spoiler_delimiter_re, find_span,
+                               "<tg-spoiler>", "</tg-spoiler>")
+
+    _strong_open_re = _LazyRegex(r"(\*\*|__)(?=\S)")
+    _em_open_re = _LazyRegex(r"(\*|_)(?=\S)")
+    _code_friendly_strong_open_re = _LazyRegex(r"\*\*(?=\S)")
+    _code_friendly_em_open_re = _LazyRegex(r"\*(?=\S)")
+    _strong_close_re = _LazyRegex(r"(?<=\S)\*\*")
+    _underscore_strong_close_re = _LazyRegex(r"(?<=\S)__")
+    _em_close_re = _LazyRegex(r"(?<=\S)\*")
+    _underscore_em_close_re = _LazyRegex(r"(?<=\S)_")
+    _emphasis_run_re = _LazyRegex(r"[*_]*")
 
-    _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
-    _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
-    _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
-    _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
     def _do_italics_and_bold(self, text):
         # <strong> must go first:
         if "code-friendly" in self.extras:
-            text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
-            text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
+            text = self._do_strong(text, self._code_friendly_strong_open_re)
+            text = self._do_em(text, self._code_friendly_em_open_re)
         else:
-            text = self._strong_re.sub(r"<strong>\2</strong>", text)
-            text = self._em_re.sub(r"<em>\2</em>", text)
+            text = self._do_strong(text, self._strong_open_re)
+            text = self._do_em(text, self._em_open_re)
         return text
 
+    def _do_strong(self, text, open_re):
+        closers = {"**": _NextMatch(self._strong_close_re, text),
+                   "__": _NextMatch(self._underscore_strong_close_re, text)}
+
+        def find_span(match):
+            delimiter = match.group()
+            close = closers[delimiter].start(match.end() + 1)
+            if close < 0:
+                return None
+            # The text may end with a run of "*" and "_", which is closed by
+            # the last delimiter in it.
+            run_end = self._emphasis_run_re.match(text, close).end()
+            close = text.rfind(delimiter, close, run_end)
+            return match.end(), close, close + 2
+        return self._sub_spans(text, open_re, find_span, "<strong>", "</strong>")
+
+    def _do_em(self, text, open_re):
+        closers = {"*": _NextMatch(self._em_close_re, text),
+                   "_": _NextMatch(self._underscore_em_close_re, text)}
+
+        def find_span(match):
+            close = closers[match.group()].start(match.end() + 1)
+            if close < 0:
+                return None
+            return match.end(), close, close + 1
+        return self._sub_spans(text, open_re, find_span, "<em>", "</em>")
+
+    def _sub_spans(self, text, open_re, find_span, start_tag, end_tag):
+        """Replace each span of text between an opening delimiter matching
+        `open_re` and its closing delimiter with the text between the tags.
+
+        `find_span(match)` returns the start and end of the text, and the
+        end of the closing delimiter, of the span opened by the delimiter
+        matched, or None if it isn't closed. Like `re.sub()`, the next
+        span is looked for after the end of a span, or after the start of
+        a delimiter that isn't closed.
+        """
+        pieces = []
+        pos = search_pos = 0
+        while True:
+            match = open_re.search(text, search_pos)
+            if match is None:
+                break
+            self._check_time_budget()
+            span = find_span(match)
+            if span is None:
+                search_pos = match.start() + 1
+                continue
+            start, end, search_pos = span
+            pieces.append(text[pos:match.start()])
+            pieces.append(start_tag)
+            pieces.append(text[start:end])
+            pieces.append(end_tag)
+            pos = search_pos
+        if not pieces:
+            return text
+        pieces.append(text[pos:])
+        return "".join(pieces)
+
     # "smarty-pants" extra: Very liberal in interpreting a single prime as an
     # apostrophe; e.g. ignores the fact that "round", "bout", "twer", and
     # "twixt" can be written without an initial apostrophe. This is fine because
     # using scare quotes (single quotation marks) is rare.
-    _apostrophe_year_re = re.compile(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
+    _apostrophe_year_re = _LazyRegex(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
     _contractions = ["tis", "twas", "twer", "neath", "o", "n",
         "round", "bout", "twixt", "nuff", "fraid", "sup"]
     def _do_smart_contractions(self, text):
@@ -2315,10 +3065,10 @@ class Markdown(object):
         return text
 
     # Substitute double-quotes before single-quotes.
-    _opening_single_quote_re = re.compile(r"(?<!\S)'(?=\S)")
-    _opening_double_quote_re = re.compile(r'(?<!\S)"(?=\S)')
-    _closing_single_quote_re = re.compile(r"(?<=\S)'")
-    _closing_double_quote_re = re.compile(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
+    _opening_single_quote_re = _LazyRegex(r"(?<!\S)'(?=\S)")
+    _opening_double_quote_re = _LazyRegex(r'(?<!\S)"(?=\S)')
+    _closing_single_quote_re = _LazyRegex(r"(?<=\S)'")
+    _closing_double_quote_re = _LazyRegex(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
     def _do_smart_punctuation(self, text):
         """Fancifies 'single quotes', "double quotes", and apostrophes.
         Converts --, ---, and ... into en dashes, em dashes, and ellipses.
@@ -2361,12 +3111,12 @@ class Markdown(object):
           )+
         )
     '''
-    _block_quote_re = re.compile(_block_quote_base % '', re.M | re.X)
-    _block_quote_re_spoiler = re.compile(_block_quote_base % '[ \t]*?!?', re.M | re.X)
-    _bq_one_level_re = re.compile('^[ \t]*>[ \t]?', re.M)
-    _bq_one_level_re_spoiler = re.compile('^[ \t]*>[ \t]*?![ \t]?', re.M)
-    _bq_all_lines_spoilers = re.compile(r'\A(?:^[ \t]*>[ \t]*?!.*[\n\r]*)+\Z', re.M)
-    _html_pre_block_re = re.compile(r'(\s*<pre>.+?</pre>)', re.S)
+    _block_quote_re = _LazyRegex(_block_quote_base % '', re.M | re.X)
+    _block_quote_re_spoiler = _LazyRegex(_block_quote_base % '[ \t]*?!?', re.M | re.X)
+    _bq_one_level_re = _LazyRegex('^[ \t]*>[ \t]?', re.M)
+    _bq_one_level_re_spoiler = _LazyRegex('^[ \t]*>[ \t]*?![ \t]?', re.M)
+    _bq_all_lines_spoilers = _LazyRegex(r'\A(?:^[ \t]*>[ \t]*?!.*[\n\r]*)+\Z', re.M)
+    _html_pre_block_re = _LazyRegex(r'(\s*<pre>.+?</pre>)', re.S)
     def _dedent_two_spaces_sub(self, match):
         return re.sub(r'(?m)^  ', '', match.group(1))
 
@@ -2439,9 +3189,9 @@ class Markdown(object):
                 if cuddled_list:
                     grafs.append(cuddled_list)
 
-        return "\n\n".join(grafs)
+        return grafs
 
-    def _add_footnotes(self, text):
+    def _add_footnotes(self, grafs):
         if self.footnotes:
             footer = [
                 '<div class="footnotes">',
@@ -2481,12 +3231,10 @@ class Markdown(object):
                 footer.append('</li>')
             footer.append('</ol>')
             footer.append('</div>')
-            return text + '\n\n' + '\n'.join(footer)
-        else:
-            return text
+            grafs.append('\n'.join(footer))
 
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    _naked_lt_re = _LazyRegex(r'<(?![a-z/?\$!])', re.I)
+    _naked_gt_re = _LazyRegex(r'''(?<![a-z0-9?!/'"-])>''', re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
@@ -2502,7 +3250,7 @@ class Markdown(object):
         text = self._naked_gt_re.sub('&gt;', text)
         return text
 
-    _incomplete_tags_re = re.compile(r"<(/?\w+?(?!\w)\s*?.+?[\s/]+?)")
+    _incomplete_tags_re = _LazyRegex(r"<(/?\w+?(?!\w)\s*?.+?[\s/]+?)")
 
     def _encode_incomplete_tags(self, text):
         if self.safe_mode not in ("replace", "escape"):
@@ -2517,16 +3265,18 @@ class Markdown(object):
         return self._incomplete_tags_re.sub(incomplete_tags_sub, text)
 
     def _encode_backslash_escapes(self, text):
+        if '\\' not in text:
+            return text
         for ch, escape in list(self._escape_table.items()):
             text = text.replace("\\"+ch, escape)
         return text
 
-    _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
+    _auto_link_re = _LazyRegex(r'<((https?|ftp):[^\'">\s]+)>', re.I)
     def _auto_link_sub(self, match):
         g1 = match.group(1)
         return '<a href="%s">%s</a>' % (self._protect_url(g1), g1)
 
-    _auto_email_link_re = re.compile(r"""
+    _auto_email_link_re = _LazyRegex(r"""
           <
            (?:mailto:)?
           (
@@ -2565,13 +3315,18 @@ class Markdown(object):
                % (''.join(chars), ''.join(chars[7:]))
         return addr
 
-    _basic_link_re = re.compile(r'!?\[.*?\]\(.*?\)')
+    _basic_link_re = _LazyRegex(r'!?\[.*?\]\(.*?\)')
     def _do_link_patterns(self, text):
         link_from_hash = {}
         for regex, repl in self.link_patterns:
+            # Spans of the links hashed by the previous patterns.
+            hashed_spans = [m.span() for m in _placeholder_re.finditer(text)
+                            if m.group(0) in link_from_hash]
+            hashed_starts = [span[0] for span in hashed_spans]
             replacements = []
             for match in regex.finditer(text):
-                if any(self._match_overlaps_substr(text, match, h) for h in link_from_hash):
+                if any(self._span_overlaps_point(hashed_spans, hashed_starts, pos)
+                       for pos in match.span()):
                     continue
 
                 if hasattr(repl, "__call__"):
@@ -2579,26 +3334,46 @@ class Markdown(object):
                 else:
                     href = match.expand(repl)
                 replacements.append((match.span(), href))
+
+            # The replacements are made from the last to the first, as if
+            # each was spliced into the text in turn. The text before
+            # `pos` is still that of `text`, and the text after it is the
+            # concatenation of `tail`, in reverse order.
+            pos = len(text)
+            tail = []
             for (start, end), href in reversed(replacements):
+                following = text[end:min(end + 3, pos)]
+                if len(following) < 3:
+                    following += self._text_from_tail(tail, 3 - len(following))
 
                 # Do not match against links inside brackets.
-                if text[start - 1:start] == '[' and text[end:end + 1] == ']':
+                if text[start - 1:start] == '[' and following[:1] == ']':
                     continue
 
                 # Do not match against links in the standard markdown syntax.
-                if text[start - 2:start] == '](' or text[end:end + 2] == '")':
+                if text[start - 2:start] == '](' or following[:2] == '")':
                     continue
 
                 # Do not match against links which are escaped.
-                if text[start - 3:start] == '"""' and text[end:end + 3] == '"""':
-                    text = text[:start - 3] + text[start:end] + text[end + 3:]
+                if text[start - 3:start] == '"""' and following[:3] == '"""':
+                    tail.append(text[end:pos])
+                    self._drop_from_tail(tail, 3)
+                    tail.append(text[start:end])
+                    pos = start - 3
                     continue
 
-                # search the text for anything that looks like a link
+                # search the line for anything that looks like a link (links
+                # don't span lines)
+                line_start = text.rfind('\n', 0, start) + 1
+                line_end = text.find('\n', end, pos)
+                if line_end == -1:
+                    line = text[line_start:pos] + self._line_from_tail(tail)
+                else:
+                    line = text[line_start:line_end]
                 is_inside_link = False
                 for link_re in (self._auto_link_re, self._basic_link_re):
-                    for match in link_re.finditer(text):
-                        if any((r[0] <= start and end <= r[1]) for r in match.regs):
+                    for match in link_re.finditer(line):
+                        if match.start() <= start - line_start and end - line_start <= match.end():
                             # if the link pattern start and end pos is within the bounds of
                             # something that looks like a link, then don't process it
                             is_inside_link = True
@@ -2616,22 +3391,87 @@ class Markdown(object):
                         .replace('*', self._escape_table['*'])
                         .replace('_', self._escape_table['_']))
                 link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
+                hash = self._hash_text(link)
                 link_from_hash[hash] = link
-                text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+                tail.append(text[end:pos])
+                tail.append(hash)
+                pos = start
+            if tail:
+                tail.append(text[:pos])
+                text = ''.join(reversed(tail))
 
-    def _unescape_special_chars(self, text):
-        # Swap back in all the special characters we've hidden.
-        while True:
-            orig_text = text
-            for ch, hash in list(self._escape_table.items()) + list(self._code_table.items()):
-                text = text.replace(hash, ch)
-            if text == orig_text:
+        def unhash_link(match):
+            return link_from_hash.get(match.group(0), match.group(0))
+        return _placeholder_re.sub(unhash_link, text)
+
+    @staticmethod
+    def _text_from_tail(tail, n):
+        """Return the first `n` characters of the text of `tail` (see
+        `_do_link_patterns`).
+        """
+        pieces = []
+        for piece in reversed(tail):
+            pieces.append(piece[:n])
+            n -= len(pieces[-1])
+            if not n:
                 break
-        return text
+        return ''.join(pieces)
+
+    @staticmethod
+    def _line_from_tail(tail):
+        """Return the text of `tail` up to the first newline."""
+        pieces = []
+        for piece in reversed(tail):
+            line_end = piece.find('\n')
+            if line_end != -1:
+                pieces.append(piece[:line_end])
+                break
+            pieces.append(piece)
+        return ''.join(pieces)
+
+    @staticmethod
+    def _drop_from_tail(tail, n):
+        """Remove the first `n` characters of the text of `tail`."""
+        while n and tail:
+            piece = tail.pop()
+            if len(piece) > n:
+                tail.append(piece[n:])
+                break
+            n -= len(piece)
+
+    @staticmethod
+    def _span_overlaps_point(spans, starts, pos):
+        """Return whether `pos` lies within any of the sorted `spans`,
+        including their ends. `starts` are the starts of the spans.
+        """
+        i = bisect_right(starts, pos) - 1
+        return i >= 0 and pos <= spans[i][1]
+
+    def _unescape_special_chars(self, text):
+        return self._special_chars_unescaper()(text)
+
+    def _special_chars_unescaper(self):
+        # Swap back in all the special characters we've hidden, in a single
+        # scan for their placeholders. The hidden text can contain
+        # placeholders itself, which are swapped back in the same way.
+        hidden = dict((hash, ch) for ch, hash in self._escape_table.items())
+        hidden.update((hash, code) for code, hash in self._code_table.items())
+        restored = {}
+
+        def restore(match):
+            hash = match.group(0)
+            try:
+                return restored[hash]
+            except KeyError:
+                pass
+            if hash not in hidden:
+                return hash
+            # Guard against a placeholder hiding text that contains itself.
+            restored[hash] = hash
+            text = restored[hash] = _placeholder_re.sub(restore, hidden[hash])
+            return text
+
+        return lambda text: _placeholder_re.sub(restore, text)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -2701,19 +3541,6 @@ class Markdown(object):
                 blocks.append('')
         return ''.join(blocks)
 
-    @staticmethod
-    def _match_overlaps_substr(text, match, substr):
-        '''
-        Checks if a regex match overlaps with a substring in the given text.
-        '''
-        for instance in re.finditer(re.escape(substr), text):
-            start, end = instance.span()
-            if start <= match.start() <= end:
-                return True
-            if start <= match.end() <= end:
-                return True
-        return False
-
 
 class MarkdownWithExtras(Markdown):
     """A markdowner class that enables most extras:
@@ -2767,6 +3594,141 @@ def calculate_toc_html(toc):
     return '\n'.join(lines) + '\n'
 
 
+class _NextMatch(object):
+    """Finds the next match of `regex` in `text` from a position on.
+
+    The match found is kept, and only looked for again once a position
+    after its start (or before the last search) is asked for, so that
+    finding the next match from each of a series of increasing positions
+    takes linear time overall.
+    """
+    __slots__ = ('regex', 'text', '_pos', '_match')
+
+    def __init__(self, regex, text):
+        self.regex = regex
+        self.text = text
+        self._pos = len(text) + 1
+        self._match = None
+
+    def start(self, pos):
+        """Return the start of the first match at or after `pos`, or -1."""
+        match = self._match
+        if pos < self._pos or (match is not None and match.start() < pos):
+            match = self._match = self.regex.search(self.text, pos)
+            self._pos = pos
+        return -1 if match is None else match.start()
+
+
+class _Balances(object):
+    """Where the `open_c` and `close_c` characters of `text` balance out.
+
+    The characters are matched up in one pass, so that where they balance
+    out from any position is looked up, rather than scanned for up to the
+    end of the text where they don't.
+    """
+    __slots__ = ('_positions', '_depths', '_opens', '_closes', '_unmatched')
+
+    def __init__(self, text, open_c, close_c):
+        # The position of each of the characters, the number of `open_c`
+        # less that of `close_c` up to it, and the innermost `open_c` not yet
+        # closed after it, or -1.
+        self._positions = positions = []
+        self._depths = depths = []
+        self._opens = opens = []
+        # The `close_c` that closes each `open_c`, and the others.
+        self._closes = closes = {}
+        self._unmatched = unmatched = []
+        stack = []
+        depth = 0
+        for match in re.finditer('[%s]' % re.escape(open_c + close_c), text):
+            pos = match.start()
+            if text[pos] == open_c:
+                depth += 1
+                stack.append(pos)
+            else:
+                depth -= 1
+                if stack:
+                    closes[stack.pop()] = pos
+                else:
+                    unmatched.append(pos)
+            positions.append(pos)
+            depths.append(depth)
+            opens.append(stack[-1] if stack else -1)
+
+    def depth(self, pos):
+        """Return the number of `open_c` less that of `close_c` before `pos`."""
+        i = bisect_left(self._positions, pos)
+        return self._depths[i - 1] if i else 0
+
+    def end(self, start):
+        """Return the index after the `close_c` from which on there is one
+        more `close_c` than `open_c` from `start`, or -1 if there is none.
+        """
+        i = bisect_left(self._positions, start)
+        innermost = self._opens[i - 1] if i else -1
+        if innermost >= 0:
+            close = self._closes.get(innermost, -1)
+        else:
+            j = bisect_left(self._unmatched, start)
+            close = self._unmatched[j] if j < len(self._unmatched) else -1
+        return close + 1 if close >= 0 else -1
+
+
+class _Balancer(object):
+    """Finds where pairs of characters balance out in a text, in which
+    `Markdown._do_links()` may replace the text up to a point with other
+    text (see `rescan()`) any number of times.
+
+    `text[prefix_len:]` is `base[prefix_len - shift:]`, so that the
+    `_Balances` of the original text are looked up for the rest of it.
+    """
+    __slots__ = ('text', 'base', 'prefix_len', 'shift', '_balances', '_prefix_balances')
+
+    def __init__(self, text):
+        self.text = self.base = text
+        self.prefix_len = self.shift = 0
+        self._balances = {}
+        self._prefix_balances = {}
+
+    def rescan(self, prefix, pos):
+        """Return the text `prefix` followed by the current text from `pos`
+        on, which is the text from then on.
+        """
+        keep = max(pos, self.prefix_len)
+        prefix += self.text[pos:keep]
+        self.text = prefix + self.text[keep:]
+        self.shift = len(prefix) - (keep - self.shift)
+        self.prefix_len = len(prefix)
+        self._prefix_balances = {}
+        return self.text
+
+    def end(self, start, open_c, close_c):
+        """Return the index where the `open_c` and `close_c` characters of the
+        text from `start` on balance out, counting one `open_c` before it,
+        or -1 if they don't.
+        """
+        count = 1
+        if start < self.prefix_len:
+            balances = self._prefix_balances.get(open_c)
+            if balances is None:
+                balances = self._prefix_balances[open_c] = _Balances(
+                    self.text[:self.prefix_len], open_c, close_c)
+            end = balances.end(start)
+            if end >= 0:
+                return end
+            count += balances.depth(self.prefix_len) - balances.depth(start)
+            start = self.prefix_len
+        balances = self._balances.get(open_c)
+        if balances is None:
+            balances = self._balances[open_c] = _Balances(self.base, open_c, close_c)
+        pos = start - self.shift
+        for _ in range(count):
+            pos = balances.end(pos)
+            if pos < 0:
+                return -1
+        return pos + self.shift
+
+
 class UnicodeWithAttrs(str):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
@@ -2775,6 +3737,245 @@ class UnicodeWithAttrs(str):
     metadata = None
     toc_html = None
 
+
+# ---- block cache
+
+_missing = object()
+
+
+class BlockCache(object):
+    """A cache of the html of blocks of markdown, so that a converter with
+    it, e.g. `Markdown(block_cache=BlockCache())`, only converts the
+    blocks of a document that are new or changed since it last saw them.
+
+    Blocks are split at blank lines, where the output of converting the
+    whole document is the same as that of converting each block on its
+    own. Links in a block can refer to definitions in other blocks; the
+    html of such a block is only reused while those definitions are the
+    same. Some extras (footnotes, toc, header-ids, numbering and
+    markdown-in-html) number or nest things across the document, and
+    converters with them convert the whole document as usual.
+
+    The cache holds up to `max_blocks` blocks, dropping the least recently
+    used. It can be shared by converters with different options, and by
+    converters in different threads. `hits` and `misses` count the blocks
+    whose html was reused, and that were converted.
+    """
+    def __init__(self, max_blocks=10000):
+        self.max_blocks = max_blocks
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+            return block
+
+    def _put(self, key, block):
+        with self._lock:
+            self._blocks[key] = block
+            self._blocks.move_to_end(key)
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+
+class _LinkDefs(dict):
+    """The link definitions (urls or titles) for a block converted on its
+    own: its own, `defs`, and those of the document, recording the ids
+    looked up in `lookups`.
+    """
+    def __init__(self, defs, document_defs):
+        dict.__init__(self, defs)
+        self.update(document_defs)
+        self.defs = defs
+        self.lookups = {}
+
+    def __contains__(self, key):
+        value = self.lookups[key] = dict.get(self, key, _missing)
+        return value is not _missing
+
+    def __getitem__(self, key):
+        value = self.lookups[key] = dict.__getitem__(self, key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.lookups[key] = dict.get(self, key, _missing)
+        return default if value is _missing else value
+
+
+class _CachedBlock(object):
+    __slots__ = ('urls', 'titles', 'url_lookups', 'title_lookups', 'html')
+
+    def __init__(self, urls, titles, html):
+        self.urls = urls.defs
+        self.titles = titles.defs
+        self.url_lookups = urls.lookups
+        self.title_lookups = titles.lookups
+        self.html = html
+
+    def is_current(self, urls, titles):
+        """Whether the link definitions looked up are the same in `urls`
+        and `titles`, those of the document.
+        """
+        for lookups, defs in ((self.url_lookups, urls),
+                              (self.title_lookups, titles)):
+            for key, value in lookups.items():
+                if defs.get(key, _missing) != value:
+                    return False
+        return True
+
+
+# ---- syntax highlighting
+
+# The Pygments lexers by name, shared by all converters, as they are costly
+# to look up. A lexer is only configured by its options, and tokenizes
+# without changing itself, so threads can share it. Formatters, on the other
+# hand, keep state as they format, so one is made for each code block.
+@functools.lru_cache(maxsize=64)
+def _get_pygments_lexer(lexer_name):
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        return lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _html_code_formatter_class():
+    import pygments.formatters
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            yield 0, "<code>"
+            for tup in inner:
+                yield tup
+            yield 0, "</code>"
+
+        def _add_newline(self, inner):
+            # Add newlines around the inner contents so that _strict_tag_block_re matches the outer div.
+            yield 0, "\n"
+            yield from inner
+            yield 0, "\n"
+
+        def wrap(self, source, outfile=None):
+            """Return the source with a code, pre, and div."""
+            if outfile is None:
+                # pygments >= 2.12
+                return self._add_newline(self._wrap_pre(self._wrap_code(source)))
+            else:
+                # pygments < 2.12
+                return self._wrap_div(self._add_newline(self._wrap_pre(self._wrap_code(source))))
+
+    return HtmlCodeFormatter
+
+
+class HighlightCache(object):
+    """A cache on disk of the html of code blocks highlighted with Pygments,
+    so that a converter with it, e.g.
+    `Markdown(extras=["fenced-code-blocks"], highlight_cache=HighlightCache(path))`,
+    only highlights code it hasn't highlighted before.
+
+    The html is kept in a file per code block in the directory `path`,
+    named by a hash of the code, the lexer and its options, the formatter
+    options, the version of Pygments and the source of markdown2 (with the
+    formatter, which changes without its version changing). The files are
+    written atomically, so the directory can be shared by processes
+    converting at the same time, as can the cache by threads. It isn't
+    ever cleaned up; delete it to drop the html of code that is no longer
+    used. `hits` and `misses` count the code blocks whose html was read,
+    and that were highlighted.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    # The hash of the source of markdown2, once it is read.
+    _source_hash = None
+
+    @classmethod
+    def _get_source_hash(cls):
+        from hashlib import sha256
+        if cls._source_hash is None:
+            try:
+                with open(__file__, "rb") as f:
+                    cls._source_hash = sha256(f.read()).hexdigest()
+            except OSError:
+                cls._source_hash = __version__
+        return cls._source_hash
+
+    def _key(self, codeblock, lexer, formatter_opts):
+        from hashlib import sha256
+        import pygments
+        h = sha256()
+        h.update(repr((self._get_source_hash(), pygments.__version__,
+                       type(lexer).__module__, type(lexer).__name__,
+                       sorted(lexer.options.items()),
+                       sorted(formatter_opts.items()))).encode("utf-8"))
+        h.update(b"\0")
+        h.update(codeblock.encode("utf-8"))
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + ".html")
+
+    def _get(self, key):
+        try:
+            with open(self._file(key), encoding="utf-8", newline="") as f:
+                html = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return html
+
+    def _put(self, key, html):
+        # A cache that can't be written to only costs the highlighting.
+        import tempfile
+        path = self._file(key)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(".tmp", dir=os.path.dirname(path))
+            with open(fd, "w", encoding="utf-8", newline="") as f:
+                f.write(html)
+            os.replace(tmp_path, path)
+        except OSError as ex:
+            log.debug("can't write to the highlight cache: %s", ex)
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+
 ## {{{ http://code.activestate.com/recipes/577257/ (r1)
 _slugify_strip_re = re.compile(r'[^\w\s-]')
 _slugify_hyphenate_re = re.compile(r'[-\s]+')
@@ -3033,18 +4234,20 @@ def _html_escape_url(attr, safe_mode=False):
 
 # ---- mainline
 
-class _NoReflowFormatter(argparse.RawDescriptionHelpFormatter):
-    """An argparse formatter that does NOT reflow the description."""
-    def format_description(self, description):
-        return description or ""
-
-
 def _test():
     import doctest
     doctest.testmod()
 
 
 def main(argv=None):
+    # argparse is only imported here, as it takes a while to.
+    import argparse
+
+    class _NoReflowFormatter(argparse.RawDescriptionHelpFormatter):
+        """An argparse formatter that does NOT reflow the description."""
+        def format_description(self, description):
+            return description or ""
+
     if argv is None:
         argv = sys.argv
     if not logging.root.handlers:
@@ -3081,6 +4284,17 @@ def main(argv=None):
                            "<https://github.com/trentm/python-markdown2/wiki/Extras>")
     parser.add_argument("--link-patterns-file",
                       help="path to a link pattern file")
+    parser.add_argument("--highlight-cache", metavar="DIR",
+                      help="cache the code blocks highlighted with Pygments "
+                           "in this directory, to reuse them in later runs")
+    parser.add_argument("--time-budget", metavar="SECONDS", type=float,
+                      help="fail the conversion of a document that takes "
+                           "longer than this")
+    parser.add_argument("--span-engine", choices=("regex", "scan"),
+                      default="regex",
+                      help="how to run the span-level transformations: "
+                           "'scan' skips those that can't change a span "
+                           "(default: regex)")
     parser.add_argument("--self-test", action="store_true",
                       help="run internal self-tests (some doctests)")
     parser.add_argument("--compare", action="store_true",
@@ -3133,6 +4347,11 @@ def main(argv=None):
     from os.path import abspath, dirname, exists, join
     markdown_pl = join(dirname(dirname(abspath(__file__))), "test",
                        "Markdown.pl")
+    if opts.highlight_cache:
+        highlight_cache = HighlightCache(opts.highlight_cache)
+    else:
+        highlight_cache = None
+
     if not paths:
         paths = ['-']
     for path in paths:
@@ -3156,7 +4375,8 @@ def main(argv=None):
             safe_mode=opts.safe_mode,
             extras=extras, link_patterns=link_patterns,
             use_file_vars=opts.use_file_vars,
-            cli=True)
+            cli=True, highlight_cache=highlight_cache,
+            time_budget=opts.time_budget, span_engine=opts.span_engine)
         sys.stdout.write(html)
         if extras and "toc" in extras:
             log.debug("toc_html: " +
@@ -1,15 +1,155 @@
 #! /usr/bin/env python
 
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from configparser import ConfigParser, ExtendedInterpolation
+from contextlib import contextmanager
 from glob import glob
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import repeat
 from string import Template
+from typing import Callable, Iterator, TextIO
+from urllib.parse import unquote, urlsplit
+import json
 import markdown2
+import mimetypes
 import os
 import re
 import shutil
+import sys
+import threading
+import time
+
+CONFIG_FILE = "config.ini"
 
 config = ConfigParser(interpolation=ExtendedInterpolation())
-config.read("config.ini")
+config.read(CONFIG_FILE)
+
+MARKDOWN_EXTRAS = ["metadata"]
+MANIFEST_VERSION = 1
+REQUIRED_METADATA = ("title", "date")
+# The pages built from the .md files in src_root, other than the posts.
+ROOT_PAGES = ("about", "index", "articles")
+
+templates: dict[str, "PageTemplate"] = {}
+changed_files: list[str] = []
+removed_files: list[str] = []
+front_matter_md = markdown2.Markdown(extras=["metadata"])
+# Conversions keep their state in a copy of the converter, so one converter is
+# shared by all the pages converted, including those of the dev server threads,
+# which take the metadata from the converted html rather than the converter.
+# The "scan" span engine gives the same html, faster on prose.
+md_converter = markdown2.Markdown(extras=MARKDOWN_EXTRAS, span_engine="scan")
+
+
+class BuildError(Exception):
+    pass
+
+
+class Profile:
+    """Records the wall time and bytes of each stage of a build.
+
+    The conversion of each page is recorded separately, split into the steps of
+    reading, markdown conversion, template substitution and writing.
+    """
+
+    PAGE_STEPS = ("read", "convert", "substitute", "write")
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.pages = []
+        self.page_record = None
+        self.nested_seconds = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """Times the stage; bytes processed can be added to the record yielded.
+
+        Page steps can be nested, e.g. when the converted markdown is streamed into
+        the page while it is written; the time of the inner step is then only
+        counted for that step.
+        """
+        record = {"seconds": 0.0, "bytes": 0}
+        if not self.enabled:
+            yield record
+            return
+
+        page_step = name in self.PAGE_STEPS and self.page_record is not None
+        start = time.perf_counter()
+        if page_step:
+            self.nested_seconds.append(0.0)
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            record["seconds"] = seconds
+            if page_step:
+                record["seconds"] -= self.nested_seconds.pop()
+                if self.nested_seconds:
+                    self.nested_seconds[-1] += seconds
+                self.page_record[name] += record["seconds"]
+                self.page_record["bytes_" + name] += record["bytes"]
+            else:
+                totals = self.stages.setdefault(name, {"seconds": 0.0, "bytes": 0, "count": 0})
+                totals["seconds"] += record["seconds"]
+                totals["bytes"] += record["bytes"]
+                totals["count"] += 1
+
+    @contextmanager
+    def page(self, src_md: str):
+        """Collects the steps timed while converting src_md"""
+        if not self.enabled:
+            yield
+            return
+
+        self.page_record = {"src": src_md}
+        for step in self.PAGE_STEPS:
+            self.page_record[step] = 0.0
+            self.page_record["bytes_" + step] = 0
+        try:
+            yield
+        finally:
+            self.pages.append(self.page_record)
+            self.page_record = None
+
+    def page_totals(self) -> dict[str, dict]:
+        totals = {}
+        for step in self.PAGE_STEPS:
+            totals[step] = {
+                "seconds": sum(page[step] for page in self.pages),
+                "bytes": sum(page["bytes_" + step] for page in self.pages),
+                "count": len(self.pages),
+            }
+        return totals
+
+    def report(self, slowest: int = 10) -> str:
+        lines = [f'{"stage":<24} {"count":>7} {"seconds":>10} {"bytes":>12}']
+        for name, totals in list(self.stages.items()) + list(self.page_totals().items()):
+            lines.append(f'{name:<24} {totals["count"]:>7} {totals["seconds"]:>10.3f} {totals["bytes"]:>12}')
+
+        def page_seconds(page): return sum(page[step] for step in self.PAGE_STEPS)
+        pages = sorted(self.pages, key=page_seconds, reverse=True)[:slowest]
+        if pages:
+            lines.append("")
+            lines.append(f"Slowest {len(pages)} pages:")
+            lines.append(" ".join(f"{step:>10}" for step in ("total",) + self.PAGE_STEPS) + "  page")
+            for page in pages:
+                seconds = (page_seconds(page),) + tuple(page[step] for step in self.PAGE_STEPS)
+                lines.append(" ".join(f"{s:>10.4f}" for s in seconds) + f'  {page["src"]}')
+        return "\n".join(lines)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "markdown2": markdown2.__version__,
+            "pages": self.pages,
+            "stages": {**self.stages, **self.page_totals()},
+        }, indent=1)
+
+
+profile = Profile()
 
 
 def path(key: str, filename: str = None) -> str:
@@ -22,38 +162,387 @@ def readfile(path: str) -> str:
         return f.read()
 
 
-def writefile(path: str, contents: str):
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(contents)
+def writefile(path: str, contents: str) -> bool:
+    return writebytes(path, contents.encode("utf-8"))
 
 
-def substitute(mapping: dict[str, str], in_path: str, out_path: str = None):
-    if not out_path:
-        out_path = in_path
+def writebytes(path: str, contents: bytes) -> bool:
+    """Writes contents to path, unless the file already holds exactly these contents.
+
+    The contents are written to a temporary file that then replaces path, so that
+    no one ever sees a partially written file. Written files are added to
+    changed_files.
+
+    Returns:
+      whether the file was written
+    """
+    try:
+        if os.path.getsize(path) == len(contents):
+            with open(path, "rb") as f:
+                if f.read() == contents:
+                    return False
+    except FileNotFoundError:
+        pass
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    changed_files.append(path)
+    return True
+
+
+def remove_output(path: str):
+    """Removes a file of the previous build, and adds it to removed_files"""
+    print(f"Removing: {path}")
+    os.remove(path)
+    removed_files.append(path)
+
+
+def writestream(path: str, write: Callable[[TextIO], None]) -> bool:
+    """Like writebytes(), but the contents are written to a text file by write(f).
+
+    The contents never have to be held in memory as a whole: they are written
+    straight into the temporary file, which is then compared with path in chunks.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            write(f)
+        if same_contents(tmp_path, path):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    template_text = readfile(in_path)
-    template = Template(template_text)
-    output = template.substitute(mapping)
-    writefile(out_path, output)
+    changed_files.append(path)
+    return True
 
 
-def initialize_directories():
-    """Removes old build artefacts, and generates the build directories"""
-    if os.path.exists(path("dst_root")):
-        shutil.rmtree(path("dst_root"))
+def same_contents(path: str, other_path: str) -> bool:
+    try:
+        if os.path.getsize(path) != os.path.getsize(other_path):
+            return False
+        with open(path, "rb") as f, open(other_path, "rb") as other:
+            while True:
+                chunk = f.read(1 << 16)
+                if chunk != other.read(1 << 16):
+                    return False
+                if not chunk:
+                    return True
+    except FileNotFoundError:
+        return False
 
-    for d in (path("dst_root"), path("dst_posts"), path("dst_css")):
-        os.makedirs(d, exist_ok=True)
 
-    for css in glob(path("src_css", "*.css")):
-        shutil.copy(css, path("dst_css"))
+def hashfile(path: str) -> str:
+    with open(path, "rb") as f:
+        return sha256(f.read()).hexdigest()
 
-    shutil.copytree(path("src_assets"), path("dst_assets"))
+
+class PageTemplate:
+    """A string.Template, split once into its literal text and placeholders,
+    so that it can be rendered many times without parsing it again.
+    """
+
+    def __init__(self, text: str):
+        self.literals = [""]
+        self.names = []
+        pos = 0
+        for match in Template.pattern.finditer(text):
+            self.literals[-1] += text[pos:match.start()]
+            pos = match.end()
+            if match.group("escaped") is not None:
+                self.literals[-1] += "$"
+            elif match.group("invalid") is not None:
+                line = text.count("\n", 0, match.start()) + 1
+                raise ValueError(f"Invalid placeholder in template: line {line}")
+            else:
+                self.names.append(match.group("named") or match.group("braced"))
+                self.literals.append("")
+        self.literals[-1] += text[pos:]
+
+    def render_to(self, f: TextIO, mapping: dict[str, str | Callable[[TextIO], None]]):
+        """Writes the template with the placeholders substituted from mapping.
+
+        A substitution can also be a function, which is called to write it to f.
+        """
+        f.write(self.literals[0])
+        for name, literal in zip(self.names, self.literals[1:]):
+            value = mapping[name]
+            if callable(value):
+                value(f)
+            else:
+                f.write(value)
+            f.write(literal)
+
+    def render(self, mapping: dict[str, str]) -> str:
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            parts.append(mapping[name])
+            parts.append(literal)
+        return "".join(parts)
+
+
+def load_template(path: str) -> PageTemplate:
+    """Reads and parses a template once per build"""
+    if path not in templates:
+        templates[path] = PageTemplate(readfile(path))
+    return templates[path]
+
+
+def writepage(path: str, template: PageTemplate, mapping: dict[str, str | Callable[[TextIO], None]]) -> bool:
+    """Renders the template with the substitutions in mapping straight into path.
+
+    Returns:
+      whether the file was written, see writestream()
+    """
+    def render(f):
+        with profile.stage("substitute"):
+            template.render_to(f, mapping)
+
+    with profile.stage("write") as stage:
+        written = writestream(path, render)
+        stage["bytes"] = os.path.getsize(path)
+    return written
+
+
+def initialize_directories(clean: bool = True):
+    """Removes old build artefacts, and generates the build directories.
+
+    With clean=False the existing build is kept, so that unchanged pages don't
+    have to be regenerated, and unchanged files keep their modification time.
+    """
+    with profile.stage("init directories"):
+        if clean and os.path.exists(path("dst_root")):
+            shutil.rmtree(path("dst_root"))
+
+        for d in (path("dst_root"), path("dst_posts"), path("dst_css")):
+            os.makedirs(d, exist_ok=True)
+
+    copy_css()
+    sync_assets()
 
     print("Build directories initialized.")
 
 
-def convert_md_file(src_md: str, dst_html: str, root: str) -> dict[str, str]:
+def copy_css():
+    with profile.stage("css") as stage:
+        for css in glob(path("src_css", "*.css")):
+            with open(css, "rb") as f:
+                contents = f.read()
+            writebytes(path("dst_css", os.path.basename(css)), contents)
+            stage["bytes"] += len(contents)
+
+
+def copy_file_contents(src: str, dst: str):
+    """Copies the contents of src to dst, in the kernel if possible"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+                return
+            except OSError:
+                # Not supported between these file systems; copy it ourselves.
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def copy_asset(src: str, dst: str):
+    """Replaces dst with a hard link to src, or a copy of src if it can't be linked"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            copy_file_contents(src, tmp_path)
+            shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    changed_files.append(dst)
+
+
+def is_same_asset(src: str, dst: str) -> bool:
+    """Checks whether dst is a link to, or a copy of the current version of src"""
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_stat = os.stat(src)
+    return (src_stat.st_size, src_stat.st_mtime_ns) == (dst_stat.st_size, dst_stat.st_mtime_ns)
+
+
+def sync_assets():
+    """Makes dst_assets a mirror of src_assets.
+
+    Only new and changed assets are copied, going by their size and modification
+    time, and assets that no longer exist in src_assets are removed.
+    """
+    with profile.stage("assets") as stage:
+        stage["bytes"] = _sync_assets()
+
+
+def _sync_assets() -> int:
+    """Syncs the assets, and returns the number of bytes copied"""
+    src_assets = os.path.normpath(path("src_assets"))
+    dst_assets = os.path.normpath(path("dst_assets"))
+
+    assets = set()
+    outdated = []
+    for dirpath, _dirnames, filenames in os.walk(src_assets):
+        for filename in filenames:
+            src = os.path.join(dirpath, filename)
+            dst = os.path.join(dst_assets, os.path.relpath(src, src_assets))
+            assets.add(dst)
+            if not is_same_asset(src, dst):
+                outdated.append((src, dst))
+
+    with ThreadPoolExecutor() as executor:
+        for _ in executor.map(lambda asset: copy_asset(*asset), outdated):
+            pass
+
+    for dirpath, dirnames, filenames in os.walk(dst_assets, topdown=False):
+        for filename in filenames:
+            dst = os.path.join(dirpath, filename)
+            if dst not in assets:
+                remove_output(dst)
+        if dirpath != dst_assets and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+    return sum(os.path.getsize(src) for src, _dst in outdated)
+
+
+def manifest_path() -> str:
+    return config["Paths"].get("manifest", ".mublog_manifest.json")
+
+
+def build_fingerprint() -> str:
+    """Hashes everything other than the markdown source that goes into a page:
+    the page template, the configuration, the markdown2 source and extras, and
+    the source of this script.
+
+    markdown2 is hashed rather than its version, which doesn't change when the
+    vendored copy is modified.
+    """
+    h = sha256()
+    h.update(f"mublog {hashfile(__file__)}\n".encode())
+    h.update(f"markdown2 {hashfile(markdown2.__file__)} {MARKDOWN_EXTRAS}\n".encode())
+    for section in ("Paths", "Author", "Layout"):
+        for key, value in sorted(config[section].items()):
+            h.update(f"{section}.{key}={value}\n".encode())
+    h.update(hashfile(path("src_root", "post.html")).encode())
+    return h.hexdigest()
+
+
+def load_manifest(fingerprint: str) -> dict:
+    """Loads the manifest of the previous build.
+
+    The manifest maps each source file to the stat and hash of the source it was
+    built from, and its metadata. If the previous build used a different template,
+    configuration or markdown2, none of its pages are up to date, but they are kept
+    in the manifest so that stale outputs can still be removed.
+    """
+    try:
+        with open(manifest_path(), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    if not manifest or manifest.get("version") != MANIFEST_VERSION:
+        return {"fingerprint": fingerprint, "pages": {}, "version": MANIFEST_VERSION}
+
+    invalidate_manifest(manifest, fingerprint)
+    return manifest
+
+
+def invalidate_manifest(manifest: dict, fingerprint: str):
+    """Marks every page out of date, if the fingerprint of the build changed"""
+    if manifest["fingerprint"] != fingerprint:
+        manifest["fingerprint"] = fingerprint
+        for entry in manifest["pages"].values():
+            entry["hash"] = entry["mtime"] = entry["size"] = None
+
+
+def save_manifest(manifest: dict):
+    writefile(manifest_path(), json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def is_up_to_date(src_md: str, dst_html: str, manifest: dict) -> bool:
+    """Checks whether dst_html was built from the current contents of src_md.
+
+    The source is only hashed when its size or mtime differ from the manifest,
+    so that a build with no changes doesn't have to read every post.
+    """
+    entry = manifest["pages"].get(src_md)
+    if not entry or entry["dst"] != dst_html or not os.path.exists(dst_html):
+        return False
+
+    st = os.stat(src_md)
+    if (st.st_mtime_ns, st.st_size) == (entry["mtime"], entry["size"]):
+        return True
+    if hashfile(src_md) != entry["hash"]:
+        return False
+
+    entry["mtime"], entry["size"] = st.st_mtime_ns, st.st_size
+    return True
+
+
+def record_page(src_md: str, dst_html: str, metadata: dict[str, str], manifest: dict):
+    st = os.stat(src_md)
+    manifest["pages"][src_md] = {
+        "dst": dst_html,
+        "hash": hashfile(src_md),
+        "metadata": metadata,
+        "mtime": st.st_mtime_ns,
+        "size": st.st_size,
+    }
+
+
+def build_md_file(src_md: str, dst_html: str, root: str, manifest: dict,
+                  front_matter: dict[str, str] = None) -> dict[str, str]:
+    """Converts the markdown file, unless its output is up to date.
+
+    Returns:
+      metadata from the markdown file, possibly cached in the manifest
+    """
+    if is_up_to_date(src_md, dst_html, manifest):
+        return dict(manifest["pages"][src_md]["metadata"])
+
+    metadata = convert_md_file(src_md, dst_html, root, front_matter=front_matter)
+    record_page(src_md, dst_html, metadata, manifest)
+    return dict(metadata)
+
+
+def remove_stale_pages(sources: set[str], manifest: dict):
+    """Removes outputs of pages whose sources were deleted or turned into drafts"""
+    for src_md in set(manifest["pages"]) - sources:
+        dst_html = manifest["pages"].pop(src_md)["dst"]
+        if os.path.exists(dst_html):
+            remove_output(dst_html)
+
+
+def convert_md_file(src_md: str, dst_html: str, root: str,
+                    contents_mapping: dict[str, str] = None,
+                    front_matter: dict[str, str] = None) -> dict[str, str]:
     """Converts the markdown post or page into html format.
 
     During this process, the header is prepended and the footer appended to the post.
@@ -61,78 +550,300 @@ def convert_md_file(src_md: str, dst_html: str, root: str) -> dict[str, str]:
 
       src_md: The source path to the markdown post/page file
       dst_html: The destination file where the converted html file will be saved.
+      contents_mapping: Substitutions for ${placeholders} in the converted html, if any.
+      front_matter: The metadata of the file, if already read by read_front_matter().
 
     Returns:
       metadata from the markdown file
     """
 
-    md = markdown2.Markdown(extras=["metadata"])
-    html = md.convert(readfile(src_md))
-    metadata = md.metadata
+    with profile.page(src_md):
+        if contents_mapping is not None:
+            substitutions, metadata = md_file_substitutions(src_md, dst_html, root, contents_mapping)
+            writepage(dst_html, load_template(path("src_root", "post.html")), substitutions)
+            return metadata
+
+        with profile.stage("read") as stage:
+            text = readfile(src_md)
+            stage["bytes"] = len(text)
+
+        # The title goes into the page before the contents, so it is taken from
+        # the front matter, and the converted contents are streamed into the page.
+        if front_matter is None:
+            front_matter = read_front_matter(src_md)
+        metadata = {}
+
+        def write_contents(f):
+            with profile.stage("convert") as stage:
+                start = f.tell()
+                metadata.update(md_converter.convert_to(f, text))
+                stage["bytes"] = f.tell() - start
+
+        substitutions = page_substitutions(front_matter, root, write_contents)
+        writepage(dst_html, load_template(path("src_root", "post.html")), substitutions)
+
+    return page_metadata(metadata, src_md, dst_html)
+
+
+def md_file_substitutions(src_md: str, dst_html: str, root: str,
+                          contents_mapping: dict[str, str] = None) -> tuple[dict[str, str], dict[str, str]]:
+    """Converts the markdown post or page into html format, without writing it.
+
+    Returns:
+      the substitutions for the page template, and metadata from the markdown file
+    """
+
+    with profile.stage("read") as stage:
+        text = readfile(src_md)
+        stage["bytes"] = len(text)
+
+    with profile.stage("convert") as stage:
+        html = md_converter.convert(text)
+        metadata = html.metadata
+        if contents_mapping is not None:
+            html = PageTemplate(html).render(contents_mapping)
+        stage["bytes"] = len(html)
+    metadata = page_metadata(metadata, src_md, dst_html)
+    return page_substitutions(metadata, root, html), metadata
+
+
+def page_metadata(metadata: dict[str, str], src_md: str, dst_html: str) -> dict[str, str]:
+    """Adds the source and destination paths of the page to its metadata"""
     metadata["src"] = src_md
     metadata["dst"] = dst_html
     metadata["dst_link"] = dst_html.removeprefix(path("dst_root"))
+    return metadata
+
 
-    title = f"<title>{metadata['title']}</title>\n" if "title" in md.metadata else ""
+def page_substitutions(metadata: dict[str, str], root: str,
+                       contents: str | Callable[[TextIO], None]) -> dict[str, str | Callable[[TextIO], None]]:
+    """Returns the substitutions for the page template, see PageTemplate.render_to()"""
+    title = f"<title>{metadata['title']}</title>\n" if "title" in metadata else ""
 
-    substitutions = {
+    return {
         "author_mail": config["Author"]["mail"],
-        "contents": html,
+        "contents": contents,
         "footer": config["Layout"]["footer"],
         "root": root,
         "title": title,
     }
-    substitute(substitutions, path("src_root", "post.html"), dst_html)
 
-    return metadata
 
+def read_front_matter(src_md: str) -> dict[str, str]:
+    """Reads the metadata of a markdown file, without converting it.
+
+    The metadata is parsed by markdown2's "metadata" extra, just like during
+    conversion, but the file is only read up to the end of the metadata block:
+    the closing '---' fence, or the first blank line if there is no fence.
+    """
+    fence_re = front_matter_md._meta_data_fence_pattern
+    lines = []
+    with open(src_md, encoding="utf-8") as f:
+        first_line = f.readline()
+        lines.append(first_line)
+        if first_line.startswith("---"):
+            fences = 1 if fence_re.match(first_line) else 0
+            for line in f:
+                lines.append(line)
+                if fence_re.match(line):
+                    fences += 1
+                    if fences == 2:
+                        break
+        elif first_line.strip():
+            for line in f:
+                lines.append(line)
+                if not line.strip():
+                    break
+
+    # Prepare the text like markdown2.Markdown.convert() does before extracting.
+    text = front_matter_md._detab("".join(lines) + "\n\n")
+    text = front_matter_md._ws_only_line_re.sub("", text)
 
-def convert_md_files(_path: str, root: str) -> list[dict[str, str]]:
+    md = front_matter_md._document()
+    md._extract_metadata(text)
+    return md.metadata
+
+
+def is_draft(src_post_path: str) -> bool:
+    """Whether the post is a draft, which is left out of the build"""
+    return os.path.basename(src_post_path).startswith(config["Paths"]["draft_prefix"])
+
+
+def scan_md_files(_path: str) -> list[dict[str, str]]:
     """
-    Iterate through all .md files in a directory, write out the html converted result,
-    and return a list of their metadata dictionaries.
+    Read the metadata of all .md files in a directory without converting them, and
+    return a list of metadata dictionaries like convert_md_files().
     """
 
-    draft_prefix = config["Paths"]["draft_prefix"]
     metadata_list = []
-    for src_post_path in glob(f"{_path}/*.md"):
+    for src_post_path in sorted(glob(f"{_path}/*.md")):
         basename = os.path.basename(src_post_path)
-        if not basename.startswith(draft_prefix):
+        if not is_draft(src_post_path):
             root_name, _ext = os.path.splitext(basename)
             dst_post_path = path("dst_posts", f"{root_name}.html")
 
-            print(f'Processing post: {src_post_path}')
-            metadata = convert_md_file(src_post_path, dst_post_path, root)
+            metadata = read_front_matter(src_post_path)
+            metadata["src"] = src_post_path
+            metadata["dst"] = dst_post_path
+            metadata["dst_link"] = dst_post_path.removeprefix(path("dst_root"))
             metadata["basename"] = basename
+            metadata_list.append(metadata)
+        else:
+            metadata_list.append({"skipped": src_post_path})
+
+    return metadata_list
+
+
+def validate_front_matter(src_paths: list[str]) -> dict[str, dict[str, str]]:
+    """Reads the front matter of the posts, and checks it, see check_front_matter().
+
+    Returns:
+      the front matter of each post, by its path
+    """
+    front_matters = {src_md: read_front_matter(src_md) for src_md in src_paths}
+    check_front_matter(front_matters)
+    return front_matters
+
+
+def check_front_matter(front_matters: dict[str, dict[str, str]]):
+    """Raises a BuildError listing the posts that lack required metadata, if any"""
+    errors = []
+    for src_md, metadata in front_matters.items():
+        missing = [key for key in REQUIRED_METADATA if key not in metadata]
+        if missing:
+            errors.append(f"    {src_md}: missing {', '.join(missing)}")
+
+    if errors:
+        raise BuildError("Invalid post metadata:\n" + "\n".join(errors))
+
+
+def init_worker(profiling: bool):
+    """Loads the page template in a conversion worker, before its first post"""
+    profile.enabled = profiling
+    load_template(path("src_root", "post.html"))
+
+
+def convert_md_file_in_worker(src_md: str, dst_html: str, root: str,
+                              front_matter: dict[str, str]) -> tuple[dict[str, str], list[str], list[dict]]:
+    """Converts a post in a worker process.
+
+    Returns:
+      the metadata of the post, the files written, and the profile of the conversion
+    """
+    changed_files.clear()
+    profile.pages.clear()
+    metadata = convert_md_file(src_md, dst_html, root, front_matter=front_matter)
+    return metadata, changed_files, profile.pages
+
+
+def convert_posts(posts: list[tuple[str, str, dict[str, str]]], root: str, jobs: int) -> Iterator[dict[str, str]]:
+    """Converts the (src_md, dst_html, front_matter) posts, yielding their metadata in order.
+
+    With more than one job, the posts are converted in a pool of worker processes.
+    """
+    if jobs <= 1 or len(posts) <= 1:
+        for src_md, dst_html, front_matter in posts:
+            yield convert_md_file(src_md, dst_html, root, front_matter=front_matter)
+        return
+
+    chunksize = max(1, len(posts) // (jobs * 8))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(profile.enabled,)) as executor:
+        src_paths, dst_paths, front_matters = zip(*posts)
+        for metadata, written, pages in executor.map(convert_md_file_in_worker, src_paths, dst_paths,
+                                                     repeat(root), front_matters, chunksize=chunksize):
+            changed_files.extend(written)
+            profile.pages.extend(pages)
+            yield metadata
+
+
+def convert_md_files(_path: str, root: str, manifest: dict, jobs: int = 1) -> list[dict[str, str]]:
+    """
+    Iterate through all .md files in a directory, write out the html converted result
+    of those that changed since the build recorded in the manifest, and return a list
+    of their metadata dictionaries, in the order of their file names.
+    """
+
+    with profile.stage("check posts"):
+        metadata_list, stale_posts = find_stale_posts(_path, manifest)
+
+    with profile.stage("validate posts"):
+        front_matters = validate_front_matter([src_post_path for _i, src_post_path, _dst_post_path in stale_posts])
+    if jobs > 1:
+        # Start the largest posts first, so that no worker is left with one at the end.
+        stale_posts.sort(key=lambda post: os.path.getsize(post[1]), reverse=True)
+
+    posts = [(src_post_path, dst_post_path, front_matters[src_post_path])
+             for _i, src_post_path, dst_post_path in stale_posts]
+    with profile.stage("convert posts"):
+        for (i, src_post_path, dst_post_path), metadata in zip(stale_posts, convert_posts(posts, root, jobs)):
+            print(f'Processing post: {src_post_path}')
+            record_page(src_post_path, dst_post_path, metadata, manifest)
+            metadata = dict(metadata)
+            metadata["basename"] = os.path.basename(src_post_path)
 
             print(f'    title:  {metadata["title"]}')
             print(f'    date:   {metadata["date"]}')
             print(f'    output: {metadata["dst"]}')
-            metadata_list.append(metadata)
+            metadata_list[i] = metadata
+
+    return metadata_list
+
+
+def find_stale_posts(_path: str, manifest: dict) -> tuple[list[dict[str, str]], list[tuple[int, str, str]]]:
+    """Finds the posts that changed since the build recorded in the manifest.
+
+    Returns:
+      the metadata list of the posts, with None in place of the posts that changed,
+      and the index, source and destination of each of those
+    """
+    metadata_list = []
+    stale_posts = []
+    for src_post_path in sorted(glob(f"{_path}/*.md")):
+        basename = os.path.basename(src_post_path)
+        if not is_draft(src_post_path):
+            root_name, _ext = os.path.splitext(basename)
+            dst_post_path = path("dst_posts", f"{root_name}.html")
+
+            if is_up_to_date(src_post_path, dst_post_path, manifest):
+                metadata = dict(manifest["pages"][src_post_path]["metadata"])
+                metadata["basename"] = basename
+                metadata_list.append(metadata)
+            else:
+                stale_posts.append((len(metadata_list), src_post_path, dst_post_path))
+                metadata_list.append(None)
         else:
             metadata_list.append({"skipped": src_post_path})
 
-    return metadata_list
+    return metadata_list, stale_posts
 
 
 def sort_metadata(metadata: list[dict[str, str]]):
     """Sorts posts in place in reverse chronological order, based on date"""
-    def key(metadata): return metadata["date"]
+    def key(metadata): return metadata.get("date", "")
     metadata.sort(key=key)
 
 
-if __name__ == "__main__":
-    initialize_directories()
-    convert_md_file(path("src_root", "about.md"),
-                    path("dst_root", "about.html"), ".")
-    convert_md_file(path("src_root", "index.md"),
-                    path("dst_root", "index.html"), ".")
+def generate_article_listing(metadata_list: list[dict[str, str]]) -> tuple[int, int]:
+    """Generates articles.html, listing the posts in the order given.
+
+    Returns:
+      the number of posts listed, and the number of drafts skipped
+    """
+    with profile.stage("article listing") as stage:
+        article_list, posts_processed, posts_skipped = article_listing(metadata_list)
+        stage["bytes"] = len(article_list)
+
+    print("Generating article listing ...")
+
     convert_md_file(path("src_root", "articles.md"),
-                    path("dst_root", "articles.html"), ".")
+                    path("dst_root", "articles.html"), ".", {"articles": article_list})
 
-    metadata_list = convert_md_files(path("src_posts"), "..")
-    sort_metadata(metadata_list)
+    return posts_processed, posts_skipped
 
+
+def article_listing(metadata_list: list[dict[str, str]]) -> tuple[str, int, int]:
+    """Returns the html list of the posts, the number of posts and the number of drafts"""
     posts_processed = 0
     posts_skipped = 0
 
@@ -150,8 +861,385 @@ if __name__ == "__main__":
 
     article_list += '</ul>'
 
-    print("Generating article listing ...")
+    return article_list, posts_processed, posts_skipped
+
+
+def list_posts():
+    """Prints the posts in the order of the article listing"""
+    metadata_list = scan_md_files(path("src_posts"))
+    sort_metadata(metadata_list)
+    for metadata in metadata_list:
+        if "skipped" in metadata:
+            print(f'{"draft":10}  {metadata["skipped"]}')
+        else:
+            print(f'{metadata.get("date", "?"):10}  {metadata["src"]}  {metadata.get("title", "?")}')
+
+
+def build_index():
+    """Regenerates only the article listing, from the metadata of the posts"""
+    os.makedirs(path("dst_root"), exist_ok=True)
+    metadata_list = scan_md_files(path("src_posts"))
+    check_front_matter({m["src"]: m for m in metadata_list if "src" in m})
+    sort_metadata(metadata_list)
+    posts_listed, posts_skipped = generate_article_listing(metadata_list)
+    print(f"Finished! (listed: {posts_listed}, skipped: {posts_skipped})")
+
+
+def build(clean: bool = False, jobs: int = 1, changed_list: str = None):
+    """Builds the site, regenerating only the pages whose inputs changed.
+
+    Arguments:
+
+      clean: Remove the previous build first, and regenerate every page.
+      jobs: The number of processes converting posts.
+      changed_list: A file to write the paths of the files written or removed by the build to.
+    """
+    templates.clear()
+    changed_files.clear()
+    removed_files.clear()
+    with profile.stage("manifest"):
+        fingerprint = build_fingerprint()
+        manifest = load_manifest(fingerprint)
+    initialize_directories(clean)
+    if clean:
+        manifest["pages"].clear()
+
+    posts_processed, posts_skipped = build_pages(manifest, jobs)
+
+    written = [f for f in changed_files + removed_files if f.startswith(path("dst_root"))]
+    if changed_list:
+        writefile(changed_list, "".join(f"{f}\n" for f in written))
+
+    with profile.stage("manifest"):
+        save_manifest(manifest)
+
+    print(f"Finished! (built: {posts_processed}, skipped: {posts_skipped}, "
+          f"files changed: {len(written)})")
+    return manifest
+
+
+def build_pages(manifest: dict, jobs: int = 1) -> tuple[int, int]:
+    """Regenerates the pages that are out of date in the manifest, and the article listing.
+
+    Returns:
+      the number of posts listed, and the number of drafts skipped
+    """
+    build_md_file(path("src_root", "about.md"),
+                  path("dst_root", "about.html"), ".", manifest)
+    build_md_file(path("src_root", "index.md"),
+                  path("dst_root", "index.html"), ".", manifest)
+
+    metadata_list = convert_md_files(path("src_posts"), "..", manifest, jobs)
+    remove_stale_pages({m["src"] for m in metadata_list if "src" in m} |
+                       {path("src_root", "about.md"), path("src_root", "index.md")},
+                       manifest)
+    with profile.stage("sort"):
+        sort_metadata(metadata_list)
+
+    return generate_article_listing(metadata_list)
+
+
+def rebuild_pages(changed: set[str], manifest: dict):
+    """Regenerates the pages of the changed .md files, and the article listing if
+    a post changed, taking the metadata of the other posts from the manifest.
+    """
+    for name in ("about", "index"):
+        if os.path.normpath(path("src_root", f"{name}.md")) in changed:
+            build_md_file(path("src_root", f"{name}.md"), path("dst_root", f"{name}.html"), ".", manifest)
+
+    src_posts = os.path.normpath(path("src_posts"))
+    posts = [path("src_posts", os.path.basename(src)) for src in sorted(changed)
+             if src.endswith(".md") and os.path.dirname(src) == src_posts]
+    if not posts and os.path.normpath(path("src_root", "articles.md")) not in changed:
+        return
+
+    # Deleted posts and drafts are removed, the others are converted.
+    sources = {src_md for src_md in posts if os.path.exists(src_md) and not is_draft(src_md)}
+    front_matters = validate_front_matter(sorted(sources))
+    for src_md in posts:
+        if src_md in sources:
+            root_name, _ext = os.path.splitext(os.path.basename(src_md))
+            build_md_file(src_md, path("dst_posts", f"{root_name}.html"), "..", manifest,
+                          front_matters[src_md])
+    remove_stale_pages(set(manifest["pages"]) - (set(posts) - sources), manifest)
+
+    metadata_list = [dict(entry["metadata"]) for src_md, entry in sorted(manifest["pages"].items())
+                     if os.path.dirname(os.path.normpath(src_md)) == src_posts]
+    sort_metadata(metadata_list)
+    generate_article_listing(metadata_list)
+
+
+def snapshot_sources() -> dict[str, tuple[int, int]]:
+    """Returns the modification time and size of every file the build reads"""
+    # The source directories are walked once each, skipping those within another.
+    roots = []
+    for key in ("src_root", "src_posts", "src_css", "src_assets"):
+        root = os.path.normpath(path(key))
+        if not any(root == other or root.startswith(other + os.sep) for other in roots):
+            roots = [other for other in roots if not other.startswith(root + os.sep)] + [root]
+
+    snapshot = {}
+    for root in roots:
+        for dirpath, _dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                src = os.path.normpath(os.path.join(dirpath, filename))
+                try:
+                    st = os.stat(src)
+                except FileNotFoundError:
+                    continue
+                snapshot[src] = (st.st_mtime_ns, st.st_size)
+    if os.path.exists(CONFIG_FILE):
+        st = os.stat(CONFIG_FILE)
+        snapshot[os.path.normpath(CONFIG_FILE)] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+def rebuild(changed: set[str], manifest: dict, jobs: int = 1):
+    """Regenerates what depends on the changed source files"""
+    def is_in(key: str, src: str) -> bool:
+        return src.startswith(os.path.normpath(path(key)) + os.sep)
+
+    changed_files.clear()
+    removed_files.clear()
+    if os.path.normpath(CONFIG_FILE) in changed:
+        config.read(CONFIG_FILE)
+
+    layout = {os.path.normpath(CONFIG_FILE), os.path.normpath(path("src_root", "post.html"))}
+    if changed & layout:
+        templates.clear()
+        invalidate_manifest(manifest, build_fingerprint())
+
+    if any(is_in("src_css", src) for src in changed):
+        copy_css()
+    if any(is_in("src_assets", src) for src in changed):
+        sync_assets()
+    if changed & layout:
+        build_pages(manifest, jobs)
+    elif any(src.endswith(".md") for src in changed):
+        rebuild_pages(changed, manifest)
+
+    for dst in changed_files:
+        print(f"Updated: {dst}")
+
+
+def watch(jobs: int = 1, interval: float = 0.2):
+    """Builds the site, then rebuilds the affected pages whenever a source file changes"""
+    manifest = build(jobs=jobs)
+    snapshot = snapshot_sources()
+    print("Watching for changes ...")
+    try:
+        while True:
+            time.sleep(interval)
+            new_snapshot = snapshot_sources()
+            if new_snapshot == snapshot:
+                continue
+
+            changed = {src for src in snapshot.keys() | new_snapshot.keys()
+                       if snapshot.get(src) != new_snapshot.get(src)}
+            snapshot = new_snapshot
+            start = time.perf_counter()
+            try:
+                rebuild(changed, manifest, jobs)
+            except (BuildError, OSError, KeyError, ValueError) as e:
+                print(f"Build failed: {e}")
+                continue
+            print(f"Rebuilt in {(time.perf_counter() - start) * 1000:.0f} ms")
+    finally:
+        # Saving the manifest of a large site takes a while, so it is only
+        # saved once, on the way out.
+        save_manifest(manifest)
 
-    substitute({"articles": article_list}, path("dst_root", "articles.html"))
 
-    print(f"Finished! (built: {posts_processed}, skipped: {posts_skipped})")
+class PageCache:
+    """A thread-safe LRU cache of rendered pages.
+
+    Each page is stored with the version of the sources it was rendered from,
+    and is only returned for that same version.
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, version: tuple) -> bytes:
+        with self.lock:
+            entry = self.pages.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.pages.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, version: tuple, page: bytes):
+        with self.lock:
+            self.pages[key] = (version, page)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+
+def source_version(*paths: str) -> tuple:
+    """Returns the modification times and sizes of the paths, None for missing ones"""
+    version = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            version.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+class DevRequestHandler(BaseHTTPRequestHandler):
+    """Serves the site straight from the sources, rendering pages when they're requested"""
+
+    page_cache = PageCache()
+    render_lock = threading.Lock()
+    template_version = None
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body: bool):
+        url_path = unquote(urlsplit(self.path).path).lstrip("/")
+        if not url_path or url_path.endswith("/"):
+            url_path += "index.html"
+
+        try:
+            content_type, body = self.render(os.path.normpath(url_path))
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        except (BuildError, KeyError, ValueError) as e:
+            self.send_error(500, explain=str(e))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def render(self, url_path: str) -> tuple[str, bytes]:
+        """Returns the content type and the contents of the file at url_path"""
+        if url_path.startswith(("..", "/")):
+            raise FileNotFoundError(url_path)
+
+        dst_html = path("dst_root", url_path)
+        root_name, ext = os.path.splitext(os.path.basename(url_path))
+        directory = os.path.dirname(url_path)
+        # Only the pages that a build writes are served.
+        if ext == ".html" and not directory and root_name in ROOT_PAGES:
+            return "text/html; charset=utf-8", self.render_page(
+                path("src_root", f"{root_name}.md"), dst_html, ".")
+        src_post = path("src_posts", f"{root_name}.md")
+        if ext == ".html" and directory == self.url_dir("dst_posts") and not is_draft(src_post):
+            return "text/html; charset=utf-8", self.render_page(
+                src_post, dst_html, "..")
+
+        for key in ("css", "assets"):
+            url_dir = self.url_dir(f"dst_{key}")
+            if url_path.startswith(url_dir + os.sep):
+                src = os.path.join(path(f"src_{key}"), os.path.relpath(url_path, url_dir))
+                content_type = mimetypes.guess_type(src)[0] or "application/octet-stream"
+                with open(src, "rb") as f:
+                    return content_type, f.read()
+
+        raise FileNotFoundError(url_path)
+
+    @staticmethod
+    def url_dir(key: str) -> str:
+        return os.path.relpath(path(key), path("dst_root"))
+
+    def render_page(self, src_md: str, dst_html: str, root: str) -> bytes:
+        if not os.path.exists(src_md):
+            raise FileNotFoundError(src_md)
+
+        template_path = path("src_root", "post.html")
+        template_version = source_version(template_path)
+        with self.render_lock:
+            if template_version != DevRequestHandler.template_version:
+                templates.pop(template_path, None)
+                DevRequestHandler.template_version = template_version
+        version = source_version(src_md) + template_version
+
+        is_listing = dst_html == path("dst_root", "articles.html")
+        if is_listing:
+            posts = sorted(glob(path("src_posts", "*.md")))
+            version += tuple(posts) + source_version(*posts)
+
+        page = self.page_cache.get(dst_html, version)
+        if page is not None:
+            return page
+
+        contents_mapping = None
+        if is_listing:
+            metadata_list = scan_md_files(path("src_posts"))
+            sort_metadata(metadata_list)
+            contents_mapping = {"articles": article_listing(metadata_list)[0]}
+
+        substitutions, _metadata = md_file_substitutions(src_md, dst_html, root, contents_mapping)
+        page = load_template(template_path).render(substitutions).encode("utf-8")
+        self.page_cache.put(dst_html, version, page)
+        return page
+
+
+def serve(port: int):
+    """Serves the site from the sources, without building it"""
+    server = ThreadingHTTPServer(("localhost", port), DevRequestHandler)
+    print(f"Serving on http://localhost:{port}/ ...")
+    with server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generates the blog from the src directory.")
+    parser.add_argument("--clean", action="store_true",
+                        help="remove the previous build and regenerate every page")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of processes converting posts (default: CPU count)")
+    parser.add_argument("--profile", metavar="REPORT", nargs="?", const="mublog_profile.json",
+                        help="print the time spent in each stage of the build, and write "
+                             "a JSON report to REPORT (default: mublog_profile.json)")
+    parser.add_argument("--profile-top", metavar="N", type=int, default=10,
+                        help="number of slowest pages to print with --profile (default: 10)")
+    parser.add_argument("--changed-list", metavar="FILE",
+                        help="write the paths of the files that were written or removed to FILE")
+    parser.add_argument("--list", action="store_true",
+                        help="print the posts with their dates and titles, and exit")
+    parser.add_argument("--index-only", action="store_true",
+                        help="only regenerate the article listing")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, and rebuild what changes in the sources")
+    parser.add_argument("--serve", action="store_true",
+                        help="serve the site, rendering pages from the sources in memory")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port to serve the site on (default: 8000)")
+    args = parser.parse_args()
+
+    try:
+        if args.list:
+            list_posts()
+        elif args.index_only:
+            build_index()
+        elif args.watch:
+            watch(jobs=args.jobs)
+        elif args.serve:
+            serve(args.port)
+        else:
+            profile.enabled = bool(args.profile)
+            start = time.perf_counter()
+            build(clean=args.clean, jobs=args.jobs, changed_list=args.changed_list)
+            if args.profile:
+                profile.stages["total"] = {"seconds": time.perf_counter() - start, "bytes": 0, "count": 1}
+                print(profile.report(args.profile_top))
+                writefile(args.profile, profile.to_json())
+    except BuildError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,161 @@
+"""Tests of the incremental build of mublog.
+
+Each test builds a copy of the sample site in `src` in a temporary directory,
+changes it, and builds it again.
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import mublog
+
+CONFIG = """\
+[Paths]
+src_root = src
+src_posts = ${src_root}/posts
+src_css = ${src_root}/css
+src_assets = ${src_root}/assets
+dst_root = dst
+dst_posts = ${dst_root}/posts
+dst_css = ${dst_root}/css
+dst_assets = ${dst_root}/assets
+draft_prefix = _
+
+[Author]
+name = John Doe
+mail = johndoe@example.com
+
+[Layout]
+footer = Copyright 2023 John Doe
+"""
+
+
+class BuildTest(unittest.TestCase):
+    """A build only writes the pages whose inputs changed, and removes the
+    pages whose sources are gone.
+    """
+
+    def setUp(self):
+        cwd = os.getcwd()
+        site = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, site)
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(site)
+        shutil.copytree(os.path.join(os.path.dirname(HERE), "src"), "src")
+        self.write_config(CONFIG)
+        self.build()
+        self.posts = sorted(os.listdir("src/posts"))
+
+    def write_config(self, text):
+        with open("config.ini", "w", encoding="utf-8") as f:
+            f.write(text)
+        mublog.config.clear()
+        mublog.config.read("config.ini")
+
+    def build(self):
+        """Builds the site, and returns the paths of the files changed"""
+        with contextlib.redirect_stdout(io.StringIO()):
+            manifest = mublog.build(jobs=1, changed_list="changed.txt")
+        self.manifest = manifest
+        with open("changed.txt", encoding="utf-8") as f:
+            return set(f.read().split())
+
+    def post(self, name):
+        return os.path.join("src", "posts", name)
+
+    def page(self, name):
+        return os.path.join("dst", "posts", name.replace(".md", ".html"))
+
+    def listing(self):
+        with open("dst/articles.html", encoding="utf-8") as f:
+            return f.read()
+
+    def test_unchanged(self):
+        self.assertEqual(self.build(), set())
+
+    def test_edit(self):
+        name = self.posts[0]
+        with open(self.post(name), "a", encoding="utf-8") as f:
+            f.write("\nAn edit.\n")
+        self.assertEqual(self.build(), {self.page(name)})
+        with open(self.page(name), encoding="utf-8") as f:
+            self.assertIn("An edit.", f.read())
+        self.assertEqual(self.manifest["pages"][self.post(name)]["hash"],
+                         mublog.hashfile(self.post(name)))
+
+    def test_touch(self):
+        # A source with a new mtime, but the same contents, isn't converted.
+        name = self.posts[0]
+        os.utime(self.post(name), ns=(0, 0))
+        with mock.patch.object(mublog, "convert_md_file", wraps=mublog.convert_md_file) as convert_md_file:
+            self.assertEqual(self.build(), set())
+        # Only the article listing is.
+        self.assertEqual([call.args[0] for call in convert_md_file.call_args_list], ["src/articles.md"])
+
+    def test_delete(self):
+        name = self.posts[0]
+        os.remove(self.post(name))
+        self.assertEqual(self.build(), {self.page(name), "dst/articles.html"})
+        self.assertFalse(os.path.exists(self.page(name)))
+        self.assertNotIn(self.post(name), self.manifest["pages"])
+        self.assertNotIn(self.page(name).removeprefix("dst"), self.listing())
+
+    def test_draft(self):
+        name = self.posts[0]
+        os.rename(self.post(name), self.post("_" + name))
+        self.assertEqual(self.build(), {self.page(name), "dst/articles.html"})
+        self.assertFalse(os.path.exists(self.page(name)))
+        self.assertFalse(os.path.exists(self.page("_" + name)))
+        self.assertNotIn(self.post(name), self.manifest["pages"])
+
+    def test_rebuild(self):
+        # As when watching: the pages of the changed sources, and the listing.
+        edited, deleted = self.posts[:2]
+        with open(self.post(edited), "a", encoding="utf-8") as f:
+            f.write("\nAn edit.\n")
+        os.remove(self.post(deleted))
+        with contextlib.redirect_stdout(io.StringIO()):
+            mublog.rebuild({self.post(edited), self.post(deleted)}, self.manifest)
+        self.assertEqual(mublog.changed_files, [self.page(edited), "dst/articles.html"])
+        self.assertEqual(mublog.removed_files, [self.page(deleted)])
+        self.assertNotIn(self.page(deleted).removeprefix("dst"), self.listing())
+        mublog.save_manifest(self.manifest)
+        self.assertEqual(self.build(), set())
+
+    def test_changed_fingerprint(self):
+        # Every page is converted again, but only those whose html changed
+        # are written.
+        pages = set(self.manifest["pages"])
+        with mock.patch.object(mublog, "build_fingerprint", return_value="changed"), \
+                mock.patch.object(mublog, "convert_md_file", wraps=mublog.convert_md_file) as convert_md_file:
+            self.assertEqual(self.build(), set())
+        converted = {call.args[0] for call in convert_md_file.call_args_list}
+        self.assertEqual(converted, pages | {"src/articles.md"})
+
+    def test_changed_layout(self):
+        self.write_config(CONFIG.replace("Copyright 2023", "Copyright 2024"))
+        changed = self.build()
+        self.assertEqual(changed, {page["dst"] for page in self.manifest["pages"].values()}
+                         | {"dst/articles.html"})
+
+    def test_fingerprint(self):
+        # The fingerprint changes with the source of mublog and markdown2.
+        fingerprint = mublog.build_fingerprint()
+        for source in (mublog.__file__, mublog.markdown2.__file__):
+            hashfile = mublog.hashfile
+            with mock.patch.object(mublog, "hashfile",
+                                   lambda path: "changed" if path == source else hashfile(path)):
+                self.assertNotEqual(mublog.build_fingerprint(), fingerprint)
+
+
+if __name__ == "__main__":
+    unittest.main()